@@ -0,0 +1,431 @@
+import os
+import sys
+import json
+import time
+import random
+import base64
+import shutil
+import argparse
+import datetime
+import platform
+import resource
+import subprocess
+from array import array
+
+from main import search_shard, ThreadingEngine
+
+# --- CONFIGURATION ---
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CORPUS_DIR = os.path.join(REPO_DIR, "bench_corpus")
+DEFAULT_RESULTS = os.path.join(REPO_DIR, "bench_results.jsonl")
+
+# Corpus shapes. Every field can be overridden from the command line.
+PRESETS = {
+    'small': dict(messages=2000),
+    'deep-threads': dict(messages=20000, thread_size=2000, thread_width=1, thread_depth=2000),
+    'wide-threads': dict(messages=20000, thread_size=500, thread_width=500, thread_depth=2),
+    'broken-refs': dict(messages=20000, missing_refs=0.5, thread_index=0.5),
+    'attachments': dict(messages=5000, attach_rate=0.6, attach_kb=256, attach_dup=0.8),
+    'cyrillic': dict(messages=20000, charsets="utf-8:1,windows-1251:2,koi8-r:2"),
+    'large': dict(messages=200000, folders=20),
+    'million': dict(messages=1000000, folders=30, attach_rate=0.02),
+}
+DEFAULTS = dict(
+    messages=2000,  # Total messages in the export
+    folders=6,  # .mbox folders; message counts are skewed towards the first ones
+    thread_size=8,  # Average messages per conversation
+    thread_width=3,  # Max replies per message
+    thread_depth=12,  # Max reply depth
+    missing_refs=0.1,  # Share of replies without References/In-Reply-To
+    thread_index=0.1,  # Share of conversations carrying an Outlook Thread-Index
+    attach_rate=0.1,  # Share of messages with an attachment
+    attach_kb=32,  # Average attachment size
+    attach_dup=0.5,  # Share of attachments that repeat an earlier one (logos, signatures)
+    charsets="utf-8:6,windows-1251:1,koi8-r:1,latin1:1",  # Body charset weights
+    seed=1,
+)
+
+WORDS = {
+    'latin': "report meeting budget invoice schedule project update draft review contract release server "
+             "backup travel lunch agenda deadline client offer order payment ticket".split(),
+    'cyrillic': "отчет встреча бюджет счет график проект черновик договор выпуск сервер поездка обед "
+                "повестка срок клиент заказ оплата".split(),
+}
+MAX_REFS = 20
+SENDERS = ["Alice Smith <alice@example.com>", "Bob Jones <bob@example.org>", "Иван Петров <ivan@example.ru>",
+           "Мария <maria@example.ru>", "carol@example.net", "Support <noreply@service.example>"]
+
+
+# --- SYNTHETIC CORPUS ---
+
+def encode_word(text, charset):
+    if text.isascii(): return text
+    return f"=?{charset}?B?{base64.b64encode(text.encode(charset)).decode('ascii')}?="
+
+
+def build_message(rng, num, conv, parent_ids, ti_prefix, date, charset, attachment):
+    cyrillic = charset in ("windows-1251", "koi8-r") or (charset == "utf-8" and rng.random() < 0.3)
+    words = WORDS['cyrillic' if cyrillic else 'latin']
+    subject = ("Re: " if parent_ids else "") + " ".join(rng.choice(words) for _ in range(3)) + f" #{conv}"
+    body = "\n".join(" ".join(rng.choice(words) for _ in range(12)) for _ in range(rng.randint(3, 30)))
+    header_charset = "utf-8" if charset == "latin1" else charset
+
+    headers = [
+        f"From: {encode_word(rng.choice(SENDERS), header_charset)}",
+        f"Subject: {encode_word(subject, header_charset)}",
+        f"Date: {date.strftime('%a, %d %b %Y %H:%M:%S +0000')}",
+        f"Message-ID: <bench{num}@bench.example>",
+        "MIME-Version: 1.0",
+    ]
+    if parent_ids:
+        headers.append("References: " + " ".join(f"<{p}>" for p in parent_ids))
+        headers.append(f"In-Reply-To: <{parent_ids[-1]}>")
+    if ti_prefix:
+        headers.append(f"Thread-Index: {base64.b64encode(ti_prefix + rng.randbytes(5)).decode('ascii')}")
+
+    try:
+        body_bytes = body.encode(charset)
+    except UnicodeEncodeError:
+        body_bytes = body.encode("utf-8")
+        charset = "utf-8"
+    text_part = [f"Content-Type: text/plain; charset={charset}", "Content-Transfer-Encoding: 8bit", ""]
+
+    if attachment is None:
+        return ("\n".join(headers + text_part) + "\n").encode("ascii") + body_bytes + b"\n"
+
+    name, payload = attachment
+    boundary = f"==bench{num}=="
+    encoded = base64.encodebytes(payload).decode("ascii")
+    head = "\n".join(headers + [f'Content-Type: multipart/mixed; boundary="{boundary}"', "", f"--{boundary}"]
+                     + text_part) + "\n"
+    tail = "\n".join(["", f"--{boundary}", f'Content-Type: application/octet-stream; name="{name}"',
+                      "Content-Transfer-Encoding: base64", f'Content-Disposition: attachment; filename="{name}"',
+                      "", encoded, f"--{boundary}--", ""])
+    return head.encode("ascii") + body_bytes + tail.encode("ascii")
+
+
+def generate_corpus(export_dir, cfg):
+    """Writes a synthetic Apple Mail export (Folder.mbox/mbox files) described by cfg."""
+    rng = random.Random(cfg['seed'])
+    charsets, weights = zip(*((c, float(w)) for c, w in (item.split(":") for item in cfg['charsets'].split(","))))
+    folder_names = ["INBOX", "Sent Messages", "Archive"] + [f"Projects/P{i}" for i in range(max(0, cfg['folders'] - 3))]
+    folder_names = folder_names[:cfg['folders']]
+    folder_weights = [1.0 / (i + 1) for i in range(len(folder_names))]  # Skewed like real exports
+    files = {}
+    for name in folder_names:
+        os.makedirs(os.path.join(export_dir, f"{name}.mbox"), exist_ok=True)
+        files[name] = open(os.path.join(export_dir, f"{name}.mbox", "mbox"), "wb")
+
+    attachment_pool = []
+    start = datetime.datetime(2005, 1, 1)
+    num = conv = 0
+    try:
+        while num < cfg['messages']:
+            conv += 1
+            size = max(1, min(cfg['messages'] - num, int(rng.expovariate(1.0 / cfg['thread_size'])) + 1))
+            ti_prefix = rng.randbytes(22) if rng.random() < cfg['thread_index'] else None
+            date = start + datetime.timedelta(minutes=rng.randint(0, 10_000_000))
+            ancestry = []  # Per message in the conversation: (message id chain, reply count)
+            for i in range(size):
+                parent = None
+                if ancestry:
+                    # Reply to a random earlier message that still has room for children and depth
+                    open_slots = [k for k in range(max(0, len(ancestry) - 50), len(ancestry))
+                                  if ancestry[k][1] < cfg['thread_width'] and len(ancestry[k][0]) < cfg['thread_depth']]
+                    parent = rng.choice(open_slots) if open_slots else len(ancestry) - 1
+                    ancestry[parent][1] += 1
+                chain = (ancestry[parent][0] if parent is not None else []) + [f"bench{num}@bench.example"]
+                ancestry.append([chain, 0])
+                # Like real mail clients, References keeps the root plus the most recent ancestors
+                refs = (chain[:1] + chain[-MAX_REFS:-1] if len(chain) > MAX_REFS else chain[:-1]) \
+                    if rng.random() >= cfg['missing_refs'] else []
+
+                attachment = None
+                if rng.random() < cfg['attach_rate']:
+                    if attachment_pool and rng.random() < cfg['attach_dup']:
+                        attachment = rng.choice(attachment_pool)
+                    else:
+                        size_kb = max(1, int(rng.expovariate(1.0 / cfg['attach_kb'])))
+                        attachment = (f"file{len(attachment_pool)}.bin", rng.randbytes(size_kb * 1024))
+                        attachment_pool.append(attachment)
+
+                charset = rng.choices(charsets, weights)[0]
+                raw = build_message(rng, num, conv, refs, ti_prefix, date, charset, attachment)
+                date += datetime.timedelta(minutes=rng.randint(1, 3000))
+                folder = rng.choices(folder_names, folder_weights)[0]
+                files[folder].write(b"From bench@bench.example Thu Jan  1 00:00:00 2009\n"
+                                    + raw.replace(b"\nFrom ", b"\n>From ") + b"\n")
+                num += 1
+    finally:
+        for f in files.values(): f.close()
+
+
+def corpus_for(corpus_root, name, cfg):
+    """Generates the corpus once per configuration and reuses it on later runs."""
+    case_dir = os.path.join(corpus_root, name)
+    export_dir = os.path.join(case_dir, "Export")
+    stamp = os.path.join(case_dir, "config.json")
+    if os.path.exists(stamp):
+        with open(stamp, encoding="utf-8") as f:
+            if json.load(f) == cfg: return export_dir
+    if os.path.exists(case_dir): shutil.rmtree(case_dir)
+
+    print(f"[{name}] Generating {cfg['messages']} messages...", file=sys.stderr)
+    started = time.perf_counter()
+    generate_corpus(export_dir, cfg)
+    with open(stamp, "w", encoding="utf-8") as f: json.dump(cfg, f)
+    print(f"[{name}] Generated in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    return export_dir
+
+
+# --- SEARCH INDEX PROBE ---
+
+def search_lookup(search_dir, shard_count, term):
+    """Python mirror of the search box: load the term's shard and decode its row positions."""
+    with open(os.path.join(search_dir, f"s-{search_shard(term, shard_count)}.js"), encoding="utf-8") as f:
+        text = f.read()
+    postings = json.loads(text[text.index(",") + 1:text.rindex(")")])
+    pos, rows = 0, []
+    for delta in postings.get(term, "").split(",") if term in postings else []:
+        pos += int(delta, 36)
+        rows.append(pos)
+    return rows
+
+
+def probe_search(output_path, samples=50):
+    search_dir = os.path.join(output_path, "data", "search")
+    if not os.path.isdir(search_dir): return None
+    shard_files = sorted(os.listdir(search_dir))
+    size = sum(os.path.getsize(os.path.join(search_dir, f)) for f in shard_files)
+    rng = random.Random(0)
+    terms = rng.sample(WORDS['latin'] + WORDS['cyrillic'], min(samples, len(WORDS['latin'] + WORDS['cyrillic'])))
+    started = time.perf_counter()
+    hits = sum(len(search_lookup(search_dir, len(shard_files), t)) for t in terms)
+    return {
+        'index_bytes': size,
+        'shards': len(shard_files),
+        'lookup_ms': round((time.perf_counter() - started) * 1000 / len(terms), 3),
+        'avg_hits': round(hits / len(terms), 1),
+    }
+
+
+# --- THREADING ENGINE ---
+
+# Reference graphs fed straight into ThreadingEngine, without any mbox parsing
+GRAPH_CASES = {
+    'graph-chain': "one conversation where every message replies to the previous one",
+    'graph-reversed': "the same chain, ingested newest first so every reference points forward",
+    'graph-star': "replies to one root that also reference random, often later, siblings",
+    'graph-cycles': "rings of 2-64 messages that all reference the next one round the ring",
+    'graph-random': "random references, half of them to missing ids, plus shared Thread-Index keys",
+}
+GRAPH_MESSAGES = 1000000
+
+
+class GraphMessage:
+    __slots__ = ('mid', 'epoch', 'thread_index')
+
+    def __init__(self, mid, epoch, thread_index=None):
+        self.mid, self.epoch, self.thread_index = mid, epoch, thread_index
+
+
+def build_graph(name, n, rng):
+    """Returns (records in ingest order, flat reference array, offsets): message h refers to flat[offsets[h]:offsets[h + 1]]."""
+    flat, offsets = array('i'), array('q', [0])
+    ti_keys = [f"ti{k}" for k in range(max(1, n // 20))]
+    records = []
+    ring_start, ring_size = 0, 0
+    for h in range(n):
+        if name in ('graph-chain', 'graph-reversed'):
+            refs = range(max(0, h - MAX_REFS), h)
+        elif name == 'graph-star':
+            refs = (0, rng.randrange(1, n)) if h else ()
+        elif name == 'graph-cycles':
+            if h == ring_start + ring_size: ring_start, ring_size = h, min(rng.choice((2, 3, 8, 64)), n - h)
+            refs = (ring_start + (h - ring_start + 1) % ring_size,)
+        else:
+            refs = [rng.randrange(2 * n) for _ in range(rng.randrange(8))]  # >= n: never ingested, a ghost
+        flat.extend(refs)
+        offsets.append(len(flat))
+        ti = rng.choice(ti_keys) if name == 'graph-random' and rng.random() < 0.3 else None
+        records.append(GraphMessage(h, rng.randrange(10 ** 9) if name == 'graph-random' else h, ti))
+    if name == 'graph-reversed': records.reverse()
+    return records, flat, offsets
+
+
+def run_graph_case(name, n, seed):
+    """Times each ThreadingEngine step the way convert() drives it, on a reference graph built in memory."""
+    records, flat, offsets = build_graph(name, n, random.Random(seed))
+    engine = ThreadingEngine()
+    phases = {}
+
+    started = time.perf_counter()
+    for record in records: engine.add_message(record.mid, record)
+    phases['ingest'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for record in engine.messages(): engine.add_references(record.mid, flat[offsets[record.mid]:offsets[record.mid + 1]])
+    phases['link'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    engine.group_by_thread_index()
+    phases['thread_index'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    sizes = [len(msgs) for msgs in engine.threads()]
+    phases['threads'] = time.perf_counter() - started
+
+    scale = 1024 if sys.platform == "darwin" else 1
+    return {
+        'case': name,
+        'revision': git_revision(),
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'jobs': 1,
+        'config': {'messages': n, 'seed': seed},
+        'wall_sec': round(sum(phases.values()), 3),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+        'messages': n,
+        'threads': len(sizes),
+        'largest_thread': max(sizes, default=0),
+        'phases': {k: round(v, 3) for k, v in phases.items()},
+        'counters': {'references': len(flat), 'ghost_nodes': engine.ghosts, 'refused_cycles': engine.cycles},
+        'rates': {'references_per_sec': round(len(flat) / phases['link']) if phases['link'] else None},
+    }
+
+
+# --- RUNNER ---
+
+# Runs the converter in a fresh interpreter and reports its peak RSS plus that of its pool workers
+RUNNER = """
+import json, resource, sys
+sys.path.insert(0, {repo!r})
+import main
+code = main.main(sys.argv[1:])
+scale = 1024 if sys.platform == "darwin" else 1  # ru_maxrss is bytes on macOS, KiB on Linux
+print(json.dumps({{
+    'exit': code,
+    'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+    'workers_peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale,
+}}))
+"""
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "-C", REPO_DIR, "describe", "--always", "--dirty"],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_case(name, cfg, export_dir, out_root, jobs, extra_args):
+    report_path = os.path.join(out_root, f"{name}-report.json")
+    argv = [export_dir, "-o", out_root, "-j", str(jobs), "-q", "--report", report_path] + extra_args
+    started = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-c", RUNNER.format(repo=REPO_DIR)] + argv,
+                          capture_output=True, text=True)
+    wall = time.perf_counter() - started
+    if proc.returncode != 0:
+        raise RuntimeError(f"[{name}] converter failed:\n{proc.stderr[-2000:]}")
+    usage = json.loads(proc.stdout.strip().splitlines()[-1])
+    with open(report_path, encoding="utf-8") as f:
+        export = json.load(f)['exports'][0]
+
+    return {
+        'case': name,
+        'revision': git_revision(),
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'jobs': jobs,
+        'args': extra_args,
+        'config': cfg,
+        'wall_sec': round(wall, 3),
+        'peak_rss_kb': usage['peak_rss_kb'],
+        'workers_peak_rss_kb': usage['workers_peak_rss_kb'],
+        'input_bytes': export['input_bytes'],
+        'output_bytes': export['output_bytes'],
+        'messages': export['messages'],
+        'threads': export['threads'],
+        'phases': export['phases'],
+        'counters': export['counters'],
+        'rates': export['rates'],
+        'search': probe_search(export['output']),
+    }
+
+
+def previous_result(results_path, case, jobs, config):
+    last = None
+    if os.path.exists(results_path):
+        with open(results_path, encoding="utf-8") as f:
+            for line in f:
+                row = json.loads(line)
+                if row['case'] == case and row['jobs'] == jobs and row['config'] == config: last = row
+    return last
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark main.py on synthetic Apple Mail exports.")
+    parser.add_argument("cases", nargs="*", default=["small"],
+                        help=f"presets to run ({', '.join(PRESETS)}) or threading engine cases "
+                             f"({', '.join(GRAPH_CASES)}, {GRAPH_MESSAGES} messages unless --messages); default: small")
+    for key, value in DEFAULTS.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=type(value), default=None,
+                            help=f"override the corpus '{key}' setting (default {value})")
+    parser.add_argument("-j", "--jobs", type=int, action="append",
+                        help="worker processes for the converter; repeat to compare (default 1)")
+    parser.add_argument("--corpus-dir", default=DEFAULT_CORPUS_DIR, help="where generated corpora are cached")
+    parser.add_argument("--results", default=DEFAULT_RESULTS, help="JSON-lines file the results are appended to")
+    parser.add_argument("--converter-args", default="",
+                        help="extra arguments passed to main.py, e.g. \"--incremental\"")
+    args = parser.parse_args(argv)
+
+    overrides = {k: getattr(args, k) for k in DEFAULTS if getattr(args, k) is not None}
+    failed = False
+    for name in args.cases:
+        if name in GRAPH_CASES:
+            result = run_graph_case(name, args.messages or GRAPH_MESSAGES, args.seed or DEFAULTS['seed'])
+            before = previous_result(args.results, name, 1, result['config'])
+            with open(args.results, "a", encoding="utf-8") as f:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+            change = ""
+            if before and before['wall_sec']:
+                change = f" ({(result['wall_sec'] / before['wall_sec'] - 1) * 100:+.1f}% vs {before['revision']})"
+            print(f"{name:>14} {result['wall_sec']:>8.2f}s{change}  phases {result['phases']}  "
+                  f"{result['threads']} threads (largest {result['largest_thread']})  "
+                  f"{result['counters']['refused_cycles']} cycles refused  "
+                  f"{result['rates']['references_per_sec']} refs/s")
+            continue
+        if name not in PRESETS: parser.error(f"unknown case {name!r}")
+        cfg = {**DEFAULTS, **PRESETS[name], **overrides}
+        export_dir = corpus_for(args.corpus_dir, name, cfg)
+        out_root = os.path.join(args.corpus_dir, name, "out")
+
+        for jobs in args.jobs or [1]:
+            try:
+                result = run_case(name, cfg, export_dir, out_root, jobs, args.converter_args.split())
+            except RuntimeError as e:
+                print(e, file=sys.stderr)
+                failed = True
+                continue
+
+            before = previous_result(args.results, name, jobs, cfg)
+            with open(args.results, "a", encoding="utf-8") as f:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+            change = ""
+            if before and before['wall_sec']:
+                change = f" ({(result['wall_sec'] / before['wall_sec'] - 1) * 100:+.1f}% vs {before['revision']})"
+            search = result['search'] or {}
+            print(f"{name:>14} j={jobs:<3} {result['wall_sec']:>8.2f}s{change}  "
+                  f"rss {result['peak_rss_kb'] // 1024} MiB (workers {result['workers_peak_rss_kb'] // 1024} MiB)  "
+                  f"out {result['output_bytes'] / 1e6:.1f} MB  "
+                  f"{result['rates']['messages_per_sec']} msg/s  "
+                  f"search {search.get('index_bytes', 0) / 1e3:.0f} kB / {search.get('lookup_ms')} ms")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,57 @@
 import os
+import sys
+import time
+import logging
+import cProfile
+import pstats
+import tracemalloc
+import argparse
+import functools
 import shutil
+import json
+import sqlite3
 import html
-import mailbox
+import mmap
+import queue
+import threading
 import re
 import mimetypes
+import urllib.parse
 import hashlib
 import datetime
 import base64
 import binascii
+import tempfile
+from array import array
+from collections import OrderedDict
 from email.header import decode_header
+from email.parser import BytesHeaderParser
 from email.utils import parsedate_to_datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # --- CONFIGURATION ---
 OUTPUT_DIR_NAME = "Mac_Mail_Archive_Strict_Debug"
+INDEX_SHARD_SIZE = 2000  # Conversations per data/index/threads-N.js shard
+INDEX_ROW_HEIGHT = 52  # px, fixed so the virtual list can position rows without measuring them
+SEARCH_TERMS_PER_SHARD = 4000  # Terms per data/search/s-N.js postings shard
+SCAN_CHUNK_BYTES = 64 * 1024 * 1024  # Larger mbox files are split into chunks of about this size for --jobs
+STREAM_CHUNK_BYTES = 1024 * 1024  # Source bytes decoded or hashed at a time; larger attachments are streamed
+WRITER_THREADS = 4  # Threads writing finished pages and index files behind the main thread
+WRITER_BACKLOG = 64  # Files that may wait for a writer before the producer blocks
+DATA_URI_MIN_CHARS = 2048  # Smaller inline data: URIs (icons, spacers) stay in the HTML
+STYLE_MAX_CHARS = 32768  # Embedded <style> blocks above this are dropped (mostly Word/Outlook boilerplate)
+THREAD_PAGE_SIZE = 250  # Messages per thread page before a conversation is split (--thread-page-size)
+THREAD_PAGE_BYTES = 2 * 1024 * 1024  # Fragment bytes per thread page before it is split (--thread-page-bytes)
+READER_CACHE_SIZE = 32  # Mbox files kept mapped per process, each holding one file descriptor
+HEADER_CACHE_SIZE = 65536  # Decoded header values kept per process
+DATE_CACHE_SIZE = 65536  # Parsed Date headers (and formatted days) kept per process
+CATALOG_BATCH = 10000  # Message rows per catalog.sqlite insert transaction
+FRAGMENT_DEAD_RATIO = 0.5  # --incremental compacts .build/fragments once this share of it is no longer used
+LAZY_TABLE = "lazy/sources.sqlite"  # Under data/, where --lazy-attachments records attachment locations
+SERVE_PORT = 8000  # --serve listens here unless --port says otherwise
+SERVE_CACHE_MB = 256  # Rendered pages and decoded attachments kept by --serve (--cache-mb)
+SERVE_SOURCES = 100000  # Attachment locations --serve remembers from rendered pages, least recently used go first
 
 # CSS (Updated margin for thread count)
 RETRO_CSS = """
@@ -72,6 +111,13 @@ RETRO_CSS = """
         display: flex;
         flex-direction: column;
     }
+    .search-box {
+        margin: 8px;
+        padding: 4px 6px;
+        border: 1px solid #000;
+        font-family: inherit;
+        font-size: 12px;
+    }
     .folder-item {
         padding: 8px 12px;
         cursor: pointer;
@@ -88,14 +134,17 @@ RETRO_CSS = """
         border-right: var(--mac-border);
         background: white;
         overflow-y: auto;
-        display: flex;
-        flex-direction: column;
+        position: relative;
     }
+    .list-spacer { width: 1px; }
+    .list-rows { position: absolute; top: 0; left: 0; right: 0; }
     .mail-row {
         cursor: pointer;
         border-bottom: 1px solid #ddd;
         padding: 8px;
         font-size: 12px;
+        height: 52px; /* Must match INDEX_ROW_HEIGHT */
+        overflow: hidden;
         display: flex;
         flex-direction: column;
     }
@@ -150,26 +199,61 @@ RETRO_CSS = """
 
 
 # --- UTILITIES ---
-def safe_decode(text_bytes, encodings=['utf-8', 'windows-1251', 'koi8-r', 'latin1']):
+# Russian text is mostly lowercase letters, which are 0xE0-0xFF in windows-1251 but 0xC0-0xDF in KOI8-R
+_CP1251_LOWER = bytes(range(0xE0, 0x100))
+_KOI8_LOWER = bytes(range(0xC0, 0xE0))
+_NOT_CP1251_LOWER = bytes(b for b in range(256) if b not in _CP1251_LOWER)
+_NOT_KOI8_LOWER = bytes(b for b in range(256) if b not in _KOI8_LOWER)
+
+
+def guess_charset(text_bytes):
+    """
+    Picks the charset of undeclared 8-bit text in one pass over the bytes instead of trial decoding:
+    ASCII, then UTF-8 when it is valid, then windows-1251 or KOI8-R by where the letters fall.
+    windows-1251 wins ties, as it did when it was simply tried first.
+    """
+    if text_bytes.isascii(): return 'ascii'
+    try:
+        text_bytes.decode('utf-8')  # Validating is a single C-level pass; most mail is UTF-8
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    cp1251 = len(text_bytes.translate(None, _NOT_CP1251_LOWER))
+    koi8 = len(text_bytes.translate(None, _NOT_KOI8_LOWER))
+    return 'koi8-r' if koi8 > cp1251 else 'windows-1251'
+
+
+def safe_decode(text_bytes, encodings=None):
+    """Decodes with the first of encodings that fits, or with guess_charset() when none are declared."""
     if not text_bytes: return ""
-    for enc in encodings:
+    # KOI8-R maps every byte, so it backs up a guessed windows-1251 that hits its one undefined byte
+    for enc in encodings or (guess_charset(text_bytes), 'koi8-r'):
         try:
             return text_bytes.decode(enc)
-        except:
+        except (UnicodeDecodeError, LookupError):
             continue
     return text_bytes.decode('utf-8', errors='replace')
 
 
 def decode_header_safe(header_val):
+    # Plain values are memoized, as senders, subjects and filenames repeat across thousands of messages.
+    # Raw 8-bit headers come from the parser as email.header.Header objects, which cannot be cache keys.
+    if isinstance(header_val, str): return _decode_header_str(header_val)
+    return _decode_header(header_val)
+
+
+def _decode_header(header_val):
     if not header_val: return ""
     try:
         decoded_parts = decode_header(header_val)
         header_text = ""
         for bytes_part, encoding in decoded_parts:
             if isinstance(bytes_part, bytes):
+                # Raw 8-bit headers are labelled 'unknown-8bit', which is not a codec: guess those directly
+                if encoding == 'unknown-8bit': encoding = None
                 try:
-                    header_text += bytes_part.decode(encoding or 'utf-8')
-                except:
+                    header_text += bytes_part.decode(encoding) if encoding else safe_decode(bytes_part)
+                except (UnicodeDecodeError, LookupError):
                     header_text += safe_decode(bytes_part)
             else:
                 header_text += str(bytes_part)
@@ -178,9 +262,18 @@ def decode_header_safe(header_val):
         return str(header_val)
 
 
+_decode_header_str = functools.lru_cache(maxsize=HEADER_CACHE_SIZE)(_decode_header)
+
+
+_UNSAFE_FILENAME_RE = re.compile(r'[\\/*?:"<>|]')
+_ANGLE_ID_RE = re.compile(r'<([^>]+)>')
+_BLOB_EXT_RE = re.compile(r'\.[a-z0-9]{1,8}')
+_NON_SPACE_RE = re.compile(rb'[^ \t\n\r\x0b\x0c]')  # What bytes.strip() would keep
+
+
 def clean_filename(filename):
     if not filename: return "untitled"
-    return re.sub(r'[\\/*?:"<>|]', "_", decode_header_safe(filename))[:60]
+    return _UNSAFE_FILENAME_RE.sub("_", decode_header_safe(filename))[:60]
 
 
 def is_image(filename):
@@ -188,14 +281,37 @@ def is_image(filename):
     return guess and guess.startswith('image')
 
 
-def parse_date_strict(date_str):
-    if not date_str: return datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+_NO_DATE = ((datetime.date.min.toordinal() - _EPOCH_ORDINAL) * 86400, 0)  # Missing or unparseable dates sort first
+_MONTHS = {name: i for i, name in enumerate(('jan', 'feb', 'mar', 'apr', 'may', 'jun',
+                                             'jul', 'aug', 'sep', 'oct', 'nov', 'dec'), 1)}
+# "Tue, 1 Jul 2003 10:52:37 +0200 (CEST)": what nearly every client writes. Anything else goes to email.utils.
+_RFC2822_DATE_RE = re.compile(r'\s*(?:(?:mon|tue|wed|thu|fri|sat|sun)(?:,\s*|\s+))?(\d{1,2})\s+([a-z]{3})\s+([1-9]\d{3})\s+'
+                              r'(\d{1,2}):(\d\d)(?::(\d\d))?\s+(?:([+-])(\d\d)(\d\d)|gmt|utc?|z)\s*(?:\([^()]*\)\s*)?$', re.I)
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date(date_str):
+    """(Unix epoch, UTC offset in minutes) of a Date header, the same values parsedate_to_datetime gives."""
+    m = _RFC2822_DATE_RE.match(date_str)
+    if m:
+        day, month, year, hour, minute, second, sign, tz_hours, tz_minutes = m.groups()
+        month, hour, minute, second = _MONTHS.get(month.lower()), int(hour), int(minute), int(second or 0)
+        tzoff = (int(tz_hours) * 60 + int(tz_minutes)) * (-1 if sign == '-' else 1) if sign else 0
+        if month and hour < 24 and minute < 60 and second < 60 and -1440 < tzoff < 1440:
+            try:
+                days = datetime.date(int(year), month, int(day)).toordinal() - _EPOCH_ORDINAL
+                return days * 86400 + hour * 3600 + minute * 60 + second - tzoff * 60, tzoff
+            except ValueError:
+                pass  # 31 Feb and the like: let email.utils decide
+    if not date_str: return _NO_DATE
     try:
         dt = parsedate_to_datetime(date_str)
         if dt.tzinfo is None: dt = dt.replace(tzinfo=datetime.timezone.utc)
-        return dt
+        offset = dt.utcoffset()
+        return int(dt.timestamp()), int(offset.total_seconds()) // 60 if offset else 0
     except:
-        return datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+        return _NO_DATE
 
 
 def extract_msg_id(msg):
@@ -209,21 +325,13 @@ def extract_references(msg):
     # 1. References
     ref_header = msg.get('References', '')
     if ref_header:
-        found = re.findall(r'<([^>]+)>', ref_header)
-        refs.extend(found)
+        refs.extend(_ANGLE_ID_RE.findall(ref_header))
     # 2. In-Reply-To
     irt_header = msg.get('In-Reply-To', '')
     if irt_header:
-        found = re.findall(r'<([^>]+)>', irt_header)
-        refs.extend(found)
+        refs.extend(_ANGLE_ID_RE.findall(irt_header))
 
-    seen = set()
-    unique_refs = []
-    for r in refs:
-        if r and r not in seen:
-            unique_refs.append(r)
-            seen.add(r)
-    return unique_refs
+    return list(dict.fromkeys(refs))  # Unique, first occurrence wins
 
 
 def extract_thread_index(msg):
@@ -243,339 +351,1401 @@ def extract_thread_index(msg):
         return None
 
 
-def extract_content(msg, attachment_dir):
-    body, attachments = "", []
-    if not os.path.exists(attachment_dir): os.makedirs(attachment_dir)
-
-    if msg.is_multipart():
-        for part in msg.walk():
-            fname = part.get_filename()
-            ctype = part.get_content_type()
-            if fname or "image" in ctype:
-                if not fname: fname = f"embedded_{len(attachments)}" + (mimetypes.guess_extension(ctype) or ".bin")
-                safe_name = clean_filename(fname)
-                payload = part.get_payload(decode=True)
-                if payload:
-                    with open(os.path.join(attachment_dir, safe_name), "wb") as f: f.write(payload)
-                    attachments.append({"name": safe_name, "is_image": is_image(safe_name)})
+def blob_path(prefix, digest, filename):
+    ext = os.path.splitext(filename)[1].lower()
+    if not _BLOB_EXT_RE.fullmatch(ext): ext = ""
+    return f"{prefix}/{digest[:2]}/{digest[2:]}{ext}"
+
+
+def write_file_atomic(path, chunks):
+    """
+    Writes a content-addressed file (blob or lazy attachment) under a temporary name, then links it into place.
+    Returns whether this call created it: False when another worker got there first with the same bytes.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write under a temporary name so parallel workers storing the same blob never see a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f: f.writelines(chunks)  # Any iterable of bytes, consumed as it is written
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            return False
+        except OSError:
+            # No hard links on this file system: look once more right before renaming
+            if os.path.exists(path): return False
+            os.replace(tmp_path, path)
+        return True
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+
+
+def hash_range(hasher, buf, start, end):
+    """Feeds buf[start:end] to hasher in STREAM_CHUNK_BYTES slices, so a large range is never copied whole."""
+    for pos in range(start, end, STREAM_CHUNK_BYTES):
+        hasher.update(buf[pos:min(end, pos + STREAM_CHUNK_BYTES)])
+    return hasher
+
+
+def store_blob(data_dir, payload, filename=""):
+    """
+    Stores payload once by content hash as data/blobs/ab/cdef….ext.
+    Returns its path relative to data_dir and whether this call wrote it.
+    Identical attachments across messages share one file; directories are only created when a blob is new.
+    """
+    rel_path = blob_path("blobs", hashlib.sha256(payload).hexdigest(), filename)
+    path = os.path.join(data_dir, rel_path)
+    if os.path.exists(path): return rel_path, False
+    return rel_path, write_file_atomic(path, [payload])
+
+
+def store_part(data_dir, buf, start, end, encoding, filename=""):
+    """
+    store_blob() for the encoded attachment at buf[start:end]; returns (rel_path, written, size),
+    or None when it decodes to nothing. Parts over STREAM_CHUNK_BYTES are never held in memory:
+    a first streaming pass only hashes them, so a duplicate costs no write, and a new one is
+    decoded again straight into its file.
+    """
+    if end - start <= STREAM_CHUNK_BYTES:
+        payload = decode_payload(buf[start:end], encoding)
+        return (*store_blob(data_dir, payload, filename), len(payload)) if payload else None
+    hasher, size = hashlib.sha256(), 0
+    try:
+        for piece in iter_decoded(buf, start, end, encoding):
+            hasher.update(piece)
+            size += len(piece)
+    except binascii.Error:
+        return None
+    if not size: return None
+    rel_path = blob_path("blobs", hasher.hexdigest(), filename)
+    path = os.path.join(data_dir, rel_path)
+    if os.path.exists(path): return rel_path, False, size
+    return rel_path, write_file_atomic(path, iter_decoded(buf, start, end, encoding)), size
+
+
+def decode_payload(data, encoding):
+    """Undoes a Content-Transfer-Encoding the way Message.get_payload(decode=True) does."""
+    if encoding == 'base64':
+        try:
+            return binascii.a2b_base64(data)
+        except binascii.Error:
+            try:
+                return binascii.a2b_base64(data + b"==")  # Missing padding
+            except binascii.Error:
+                return b""
+    if encoding == 'quoted-printable':
+        return binascii.a2b_qp(data)
+    return data
+
+
+_NOT_BASE64 = bytes(b for b in range(256) if b not in b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=")
+
+
+def iter_decoded(buf, start, end, encoding):
+    """
+    decode_payload() of buf[start:end] as a series of pieces, reading STREAM_CHUNK_BYTES of the source at a time.
+    Raises binascii.Error where decode_payload() would give b"".
+    """
+    if encoding == 'base64':
+        # Characters a2b_base64 would skip are dropped up front and whole quads decoded as they come.
+        # A complete padding sequence ends the data for a2b_base64, so reading stops there; after a stray
+        # '=' the rest is decoded in one go, as a2b_base64 would see it.
+        pending, tail = b"", None
+        for pos in range(start, end, STREAM_CHUNK_BYTES):
+            piece = buf[pos:min(end, pos + STREAM_CHUNK_BYTES)].translate(None, _NOT_BASE64)
+            if tail is not None:
+                tail += piece
                 continue
+            pending += piece
+            pad = pending.find(b"=")
+            cut = len(pending) - len(pending) % 4 if pad == -1 else pad - pad % 4
+            if cut:
+                yield binascii.a2b_base64(pending[:cut])
+                pending = pending[cut:]
+            if pad == -1: continue
+            quad = pad % 4  # Position of the '=' in its quad
+            if quad == 3 or (quad == 2 and pending[3:4] == b"="):
+                pending = pending[:4]
+                break
+            if quad < 2 or len(pending) > 3: tail, pending = pending, b""
+        rest = pending if tail is None else tail
+        if rest:
             try:
-                payload = part.get_payload(decode=True)
-                if payload:
-                    decoded = safe_decode(payload, [part.get_content_charset() or 'utf-8'])
-                    if ctype == "text/html":
-                        body = decoded
-                    elif ctype == "text/plain" and not body:
-                        body = f"<pre>{html.escape(decoded)}</pre>"
-            except:
-                pass
+                yield binascii.a2b_base64(rest)
+            except binascii.Error:
+                yield binascii.a2b_base64(rest + b"==")  # Missing padding
+    elif encoding == 'quoted-printable':
+        # Decoded a line at a time. An overlong line is only cut where no '=' escape can straddle the cut,
+        # and before any '=\r', after which a2b_qp skips everything up to the next line break.
+        pending = b""
+        for pos in range(start, end, STREAM_CHUNK_BYTES):
+            pending += buf[pos:min(end, pos + STREAM_CHUNK_BYTES)]
+            cut = pending.rfind(b"\n") + 1
+            if not cut and len(pending) > STREAM_CHUNK_BYTES:
+                cut = pending.find(b"=\r")
+                if cut == -1: cut = len(pending)
+                while cut and b"=" in pending[max(0, cut - 2):cut]: cut -= 1
+            if cut:
+                yield binascii.a2b_qp(pending[:cut])
+                pending = pending[cut:]
+        if pending: yield binascii.a2b_qp(pending)
     else:
-        payload = msg.get_payload(decode=True)
-        if payload:
-            decoded = safe_decode(payload, [msg.get_content_charset() or 'utf-8'])
-            body = decoded if msg.get_content_type() == "text/html" else f"<pre>{html.escape(decoded)}</pre>"
+        for pos in range(start, end, STREAM_CHUNK_BYTES):
+            yield buf[pos:min(end, pos + STREAM_CHUNK_BYTES)]
+
+
+# One pass over an HTML body finds <style> blocks, inline base64 data: URIs and cid: references
+_STYLE_PATTERN = r'(?P<style><style\b[^>]*>.*?</style\s*>)'
+_INLINE_REF_PATTERN = (r'data:(?P<mime>[\w.+-]+/[\w.+-]+)(?:;[\w.+-]+=[\w.+-]+)*;base64,(?P<data>[A-Za-z0-9+/=\s]+)'
+                       r'|cid:(?P<cid>[^\s"\'<>)]+)')
+_HTML_REWRITE_RE = re.compile(_STYLE_PATTERN + '|' + _INLINE_REF_PATTERN, re.S | re.I)
+_INLINE_REF_RE = re.compile(_INLINE_REF_PATTERN, re.I)
+
+
+def rewrite_html(body, data_dir, cid_attachments, attachments):
+    """
+    Rewrites an HTML body in a single regex pass so thread pages stay small:
+    - base64 data: URIs of DATA_URI_MIN_CHARS or more become deduplicated blobs (appended to attachments);
+    - cid: links point at the attachment with that Content-ID, which is then shown inline only;
+    - <style> blocks over STYLE_MAX_CHARS are dropped.
+    """
+    def replace(m):
+        groups = m.groupdict()
+        if groups.get('style') is not None:
+            return "" if len(m.group(0)) > STYLE_MAX_CHARS else _INLINE_REF_RE.sub(replace, m.group(0))
+        if groups['cid'] is not None:
+            att = cid_attachments.get(urllib.parse.unquote(groups['cid']))
+            if att is None: return m.group(0)
+            att['inline'] = True
+            return att['path']
+        if len(groups['data']) < DATA_URI_MIN_CHARS: return m.group(0)
+        payload = decode_payload(groups['data'].encode('ascii'), 'base64')
+        if not payload: return m.group(0)
+        name = f"inline_{len(attachments)}" + (mimetypes.guess_extension(groups['mime'].lower()) or ".bin")
+        rel_path, written = store_blob(data_dir, payload, name)
+        attachments.append({"name": name, "path": rel_path, "size": len(payload), "written": written,
+                            "is_image": is_image(name), "inline": True})
+        return rel_path
+
+    return _HTML_REWRITE_RE.sub(replace, body)
+
+
+def extract_content(buf, start, end, data_dir, lazy=False):
+    """
+    Renders the body of the message at buf[start:end] and stores its attachments.
+    Parts are located by byte range (iter_mime_parts), so only payloads that are used get decoded.
+    With lazy, attachments are not decoded at all: each gets a data/lazy/ path named after its encoded
+    bytes plus a 'source' of (offset from start, length, transfer encoding) for materialize_attachments().
+    HTML bodies go through rewrite_html(); attachments it displays inline are flagged 'inline'.
+    """
+    body, attachments = "", []
+    is_html = False
+    cid_attachments = {}  # Content-ID -> attachment, for cid: links in the HTML body
+
+    for depth, part, part_start, part_end in iter_mime_parts(buf, start, end):
+        ctype = part.get_content_type()
+        encoding = str(part.get('content-transfer-encoding', '')).strip().lower()
+        if depth == 0:
+            # Not multipart: whatever the single part is, it is the body
+            payload = decode_payload(buf[part_start:part_end], encoding)
+            if payload:
+                decoded = safe_decode(payload, [part.get_content_charset() or 'utf-8'])
+                is_html = ctype == "text/html"
+                body = decoded if is_html else f"<pre>{html.escape(decoded)}</pre>"
+            break
+
+        fname = part.get_filename()
+        if fname or "image" in ctype:
+            if not fname: fname = f"embedded_{len(attachments)}" + (mimetypes.guess_extension(ctype) or ".bin")
+            safe_name = clean_filename(fname)
+            stored = len(attachments)
+            if lazy:
+                if _NON_SPACE_RE.search(buf, part_start, part_end):
+                    digest = hash_range(hashlib.sha256(), buf, part_start, part_end).hexdigest()
+                    attachments.append({"name": safe_name, "size": part_end - part_start, "written": False,
+                                        "path": blob_path("lazy", digest, safe_name),
+                                        "source": (part_start - start, part_end - part_start, encoding),
+                                        "is_image": is_image(safe_name)})
+            else:
+                blob = store_part(data_dir, buf, part_start, part_end, encoding, safe_name)
+                if blob:
+                    rel_path, written, size = blob
+                    attachments.append({"name": safe_name, "path": rel_path, "size": size,
+                                        "written": written, "is_image": is_image(safe_name)})
+            content_id = str(part.get('content-id', '')).strip().strip('<>')
+            if content_id and len(attachments) > stored:
+                cid_attachments[content_id] = attachments[-1]
+            continue
+        try:
+            payload = decode_payload(buf[part_start:part_end], encoding)
+            if payload:
+                decoded = safe_decode(payload, [part.get_content_charset() or 'utf-8'])
+                if ctype == "text/html":
+                    body, is_html = decoded, True
+                elif ctype == "text/plain" and not body:
+                    body = f"<pre>{html.escape(decoded)}</pre>"
+        except:
+            pass
+    if is_html: body = rewrite_html(body, data_dir, cid_attachments, attachments)
     return body, attachments
 
 
+# --- INSTRUMENTATION ---
+
+log = logging.getLogger("mbox_to_html")  # Writes to stderr, so stdout stays clean for --json
+
+
+class Metrics:
+    """
+    Phase timers and throughput counters for one conversion.
+    begin() closes the running phase and starts the next; report() gives the JSON-ready numbers.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.counters = {}
+        self._phase = None
+        self._phase_started = None
+        self._last_progress = 0.0
+
+    def begin(self, name):
+        self.end()
+        self._phase, self._phase_started = name, time.perf_counter()
+
+    def end(self):
+        if self._phase:
+            self.phases[self._phase] = round(time.perf_counter() - self._phase_started, 3)
+            self._phase = None
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def progress(self, done, total):
+        # At most one progress line per second, however fast messages go by
+        now = time.perf_counter()
+        if now - self._last_progress >= 1.0:
+            self._last_progress = now
+            log.info(f"Processing {done}/{total}...")
+
+    def report(self):
+        self.end()
+        ingest = self.phases.get('ingest') or 0
+        return {
+            'phases': self.phases,
+            'counters': self.counters,
+            'rates': {
+                'messages_per_sec': round(self.counters.get('messages', 0) / ingest, 1) if ingest else None,
+                'mb_per_sec': round(self.counters.get('mbox_bytes', 0) / 1e6 / ingest, 2) if ingest else None
+            },
+            'elapsed': round(time.perf_counter() - self.started, 3)
+        }
+
+
+# --- STREAMING MBOX READER ---
+
+_header_parser = BytesHeaderParser()
+_MESSAGE_ID_LINE_RE = re.compile(rb'^message-id:[ \t]*(?:\r?\n[ \t]+)?(\S[^\r\n]*)', re.I | re.M)
+
+
+def split_entity(buf, start, end):
+    """Returns (header block end, body start) of the MIME entity at buf[start:end]."""
+    if buf[start:start + 1] == b'\n': return start, start + 1  # No headers at all
+    if buf[start:start + 2] == b'\r\n': return start, start + 2
+    cut = [(i + 1, i + 2) for i in (buf.find(b'\n\n', start, end),) if i != -1] + \
+          [(i + 1, i + 3) for i in (buf.find(b'\n\r\n', start, end),) if i != -1]
+    return min(cut) if cut else (end, end)
+
+
+def iter_mime_parts(buf, start, end, depth=0, headers=None):
+    """
+    Walks the MIME tree of the entity at buf[start:end] without decoding anything.
+    Yields (depth, headers, body_start, body_end) for every leaf part in Message.walk() order;
+    depth is 0 only when the entity itself is not multipart. Attached message/rfc822 parts are descended into.
+    headers may pass in the entity's own headers when they are parsed already.
+    """
+    head_end, body = split_entity(buf, start, end)
+    if headers is None: headers = _header_parser.parsebytes(buf[start:head_end])
+    if headers.get_content_type() == 'message/rfc822':
+        yield from iter_mime_parts(buf, body, end, depth + 1)
+        return
+    boundary = headers.get_boundary() if headers.get_content_maintype() == 'multipart' else None
+    if not boundary:
+        yield depth, headers, body, end
+        return
+
+    delimiter = b'--' + boundary.encode('ascii', 'surrogateescape')
+    part_start, pos = None, body
+    while True:
+        i = buf.find(delimiter, pos, end)
+        if i == -1: break
+        after = i + len(delimiter)
+        pos = after
+        # Only a whole line counts: "--b" must not match the delimiter of a nested "--b2"
+        if (i != body and buf[i - 1:i] != b'\n') or \
+                (buf[after:after + 1] not in (b'\r', b'\n', b' ', b'\t', b'') and buf[after:after + 2] != b'--'):
+            continue
+        if part_start is not None:
+            # The line break before a delimiter belongs to the delimiter
+            part_end = i - 1 if buf[i - 2:i] != b'\r\n' else i - 2
+            yield from iter_mime_parts(buf, part_start, max(part_start, part_end), depth + 1)
+            part_start = None
+        if buf[after:after + 2] == b'--': return  # Closing delimiter, the rest is epilogue
+        eol = buf.find(b'\n', after, end)
+        if eol == -1: return
+        part_start = pos = eol + 1
+    if part_start is not None and part_start < end:
+        # Unterminated last part: like email.parser, drop its final line break
+        part_end = end - 2 if buf[end - 2:end] == b'\r\n' else end - 1 if buf[end - 1:end] == b'\n' else end
+        yield from iter_mime_parts(buf, part_start, max(part_start, part_end), depth + 1)
+
+
+class RawMessage:
+    """
+    One message of an mbox file, located by its byte range.
+    Headers are parsed on first access; body parts are located by iter_mime_parts() over the same buffer.
+    """
+    __slots__ = ('buf', 'start', 'end', '_headers')
+
+    def __init__(self, buf, start, end):
+        self.buf = buf
+        self.start = start  # First byte after the 'From ' separator line
+        self.end = end
+        self._headers = None
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            # Only the header block is handed to the parser, the body is never touched here
+            head_end, _ = split_entity(self.buf, self.start, self.end)
+            self._headers = _header_parser.parsebytes(self.buf[self.start:head_end])
+        return self._headers
+
+    def get(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def duplicate_key(self):
+        """
+        sha1 of the Message-ID and the body, without parsing any header: equal for copies of one message
+        filed in several folders, even when the mail client rewrote their status headers.
+        None when there is no Message-ID to go by.
+        """
+        head_end, body = split_entity(self.buf, self.start, self.end)
+        found = _MESSAGE_ID_LINE_RE.search(self.buf, self.start, head_end)
+        if not found: return None
+        return hash_range(hashlib.sha1(found.group(1).strip() + b"\0"), self.buf, body, self.end).digest()
+
+
+class MboxReader:
+    """
+    Single-pass mbox splitter over a memory-mapped file.
+    Yields RawMessage objects in file order; the file is never read twice to build a table of contents.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            try:
+                self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)  # The map keeps its own descriptor
+            except ValueError:
+                self.buf = b""  # Empty file, nothing to map
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self.buf, mmap.mmap): self.buf.close()
+
+    def __iter__(self):
+        return self.messages()
+
+    def messages(self, begin=0, stop=None):
+        """Yields the messages in buf[begin:stop]; begin is 0 or the start of a separator line (plan_chunks)."""
+        buf = self.buf
+        size = len(buf) if stop is None else stop
+        if begin:
+            pos = begin
+        else:
+            pos = 0 if buf[:5] == b"From " else buf.find(b"\nFrom ", 0, size)
+            if pos == -1: return
+            if pos: pos += 1
+
+        while pos < size:
+            # Skip the 'From ' separator line itself
+            line_end = buf.find(b"\n", pos, size)
+            start = size if line_end == -1 else line_end + 1
+
+            nxt = buf.find(b"\nFrom ", start - 1, size) if start < size else -1
+            end = size if nxt == -1 else nxt + 1
+
+            # Like mailbox.mbox, the blank line before the next separator is not part of the message
+            stop = end - 1 if end - start >= 2 and buf[end - 2:end] == b"\n\n" else end
+            yield RawMessage(buf, start, stop)
+            pos = end
+
+
+def plan_chunks(mbox_path, chunk_bytes):
+    """
+    Cuts an mbox into byte ranges of about chunk_bytes, each starting at a separator line.
+    These are the boundaries MboxReader splits on, so scanning the ranges in order gives exactly
+    the messages of one pass over the whole file. Returns [(mbox_path, begin, stop)].
+    """
+    size = os.path.getsize(mbox_path)
+    if size <= chunk_bytes: return [(mbox_path, 0, size)]
+    cuts = [0]
+    with open(mbox_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        while cuts[-1] + chunk_bytes < size:
+            nxt = buf.find(b"\nFrom ", cuts[-1] + chunk_bytes - 1)
+            if nxt == -1: break
+            cuts.append(nxt + 1)
+    cuts.append(size)
+    return [(mbox_path, begin, stop) for begin, stop in zip(cuts, cuts[1:])]
+
+
+def scan_chunk(task):
+    """
+    Splits one planned chunk, given as (mbox_path, begin, stop, with_hash), into messages.
+    Returns (start, end, duplicate key, sha1 hex or None) per message, or None when the mbox cannot be read.
+    """
+    mbox_path, begin, stop, with_hash = task
+    try:
+        return [(msg.start, msg.end, msg.duplicate_key(),
+                 hash_range(hashlib.sha1(), msg.buf, msg.start, msg.end).hexdigest() if with_hash else None)
+                for msg in _reader_for(mbox_path).messages(begin, stop)]
+    except (OSError, ValueError):
+        return None
+
+
+def scan_mboxes(chunks, with_hash=False, pool=None):
+    """
+    Runs scan_chunk() over planned chunks; on pool the largest go first, so one huge mbox does not
+    leave a single worker finishing last. Returns {chunk: result}, to be merged in file order.
+    """
+    if pool is None: return {c: scan_chunk(c + (with_hash,)) for c in chunks}
+    futures = {c: pool.submit(scan_chunk, c + (with_hash,)) for c in sorted(chunks, key=lambda c: c[1] - c[2])}
+    return {c: f.result() for c, f in futures.items()}
+
+
 # --- CORE THREADING CLASSES ---
 
-class Node:
-    def __init__(self, msg_id):
-        self.msg_id = msg_id
-        self.message = None  # None = Ghost
-        self.parent = None
-        self.children = []
-
-    def add_child(self, child_node):
-        if child_node.parent: return  # Already attached
-        child_node.parent = self
-        self.children.append(child_node)
-
-    def get_root(self):
-        curr = self
-        while curr.parent:
-            curr = curr.parent
-        return curr
-
-    def walk(self):
-        result = []
-        if self.message: result.append(self.message)
-        for child in self.children:
-            result.extend(child.walk())
-        return result
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def _format_day(days):
+    day = datetime.date.fromordinal(days + _EPOCH_ORDINAL)
+    return f"{day.year}-{day.month:02d}-{day.day:02d}"
+
+
+def format_epoch(epoch, tzoff):
+    """YYYY-MM-DD HH:MM in the message's own timezone (tzoff = UTC offset in minutes)."""
+    days, seconds = divmod(epoch + tzoff * 60, 86400)
+    return f"{_format_day(days)} {seconds // 3600:02d}:{seconds // 60 % 60:02d}"
+
+
+class StringTable:
+    """
+    Maps strings (Message-IDs) to dense integer handles and back, so the graph and the message records
+    hold small ints instead of long strings. With a path, the table lives in SQLite on disk
+    and memory stays flat however many IDs the archive has.
+    """
+
+    def __init__(self, path=None):
+        self.db, self.path = None, path
+        self._handles, self._strings = {}, []
+        if path:
+            if os.path.exists(path): os.remove(path)  # Scratch table, never reused between runs
+            self.db = sqlite3.connect(path)
+            self.db.execute("PRAGMA journal_mode = OFF")
+            self.db.execute("PRAGMA synchronous = OFF")
+            self.db.execute("CREATE TABLE IF NOT EXISTS strings (id INTEGER PRIMARY KEY, value TEXT UNIQUE)")
+            self._count = 0
+
+    def handle(self, value):
+        if self.db is None:
+            h = self._handles.get(value)
+            if h is None:
+                h = self._handles[value] = len(self._strings)
+                self._strings.append(value)
+            return h
+        row = self.db.execute("SELECT id FROM strings WHERE value = ?", (value,)).fetchone()
+        if row: return row[0]
+        self.db.execute("INSERT INTO strings VALUES (?, ?)", (self._count, value))
+        self._count += 1
+        return self._count - 1
+
+    def __getitem__(self, h):
+        if self.db is None: return self._strings[h]
+        return self.db.execute("SELECT value FROM strings WHERE id = ?", (h,)).fetchone()[0]
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            os.remove(self.path)
+
+
+class MessageRecord:
+    """
+    Compact metadata kept per ingested message for Phases 2-5: ints for the Message-ID, references and date,
+    interned strings for values that repeat across messages (folders, senders, Thread-Index keys).
+    Copies of the message found in other folders only add to dup_folders.
+    """
+    __slots__ = ('num', 'mid', 'subj', 'sender', 'epoch', 'tzoff', 'folder', 'dup_folders', 'refs',
+                 'thread_index', 'frag', 'att_count', 'att_bytes')
+
+    def __init__(self, meta, ids):
+        self.num = int(meta['local_id'][1:])
+        self.mid = ids.handle(meta['mid'])
+        self.subj = meta['subj']
+        self.sender = sys.intern(meta['sender'])
+        self.epoch = meta['epoch']
+        self.tzoff = meta['tzoff']
+        self.folder = sys.intern(meta['folder'])
+        self.dup_folders = ()
+        self.refs = tuple(ids.handle(r) for r in meta['refs'])  # Released once Phase 2 has linked it
+        self.thread_index = sys.intern(meta['thread_index']) if meta['thread_index'] else None
+        segment, offset, length = meta['frag']
+        self.frag = (sys.intern(segment), offset, length)
+        self.att_count = meta.get('att_count', 0)
+        self.att_bytes = meta.get('att_bytes', 0)  # Manifests written before the catalog do not have it
 
     @property
-    def date(self):
-        if self.message: return self.message['dt']
-        dates = [c.date for c in self.children]
-        if dates: return min(dates)
-        return datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+    def local_id(self):
+        return f"m{self.num}"
 
 
-def main():
-    print("--- DEBUG GRAPH THREADING ENGINE (STRICT) ---")
-    raw_input = input("Drag and drop your 'Mail Export' folder here: ").strip()
-    input_path = raw_input.strip("'").strip('"')
+class ThreadingEngine:
+    """
+    Groups messages into conversations over dense Message-ID handles (StringTable); unknown IDs become ghosts.
 
-    if not os.path.exists(input_path): return print("Folder not found.")
+    A link puts a message or ghost under another one unless it already has a parent (first link wins, as
+    in JWZ) or the link would close a cycle. Membership is tracked with union-find: every conversation is
+    a tree, so a link closes a cycle exactly when both ends are already in one set, which is a near
+    constant-time check instead of a walk up the tree. Display trees are only built by threads().
+    With describe (handle -> Message-ID), every linking decision is logged at debug level.
+    """
 
-    original_folder_name = os.path.basename(input_path.rstrip(os.sep))
-    output_path = os.path.join(os.path.dirname(input_path), f"{original_folder_name}_html")
+    def __init__(self, describe=None):
+        self._set = array('i')  # Union-find parent per handle; -1 = no node
+        self._size = array('i')  # Set size, valid for set representatives
+        self._parent = array('i')  # Display parent per handle; -1 = root
+        self._messages = {}  # handle -> message record, in ingest order; ghosts have none
+        self._order = array('i')  # Handles in the order their nodes were created
+        self._links = array('i')  # Children in the order they were attached
+        self.describe = describe
+        self.ghosts = 0
+        self.cycles = 0  # Links refused because they would have closed a cycle
+
+    def __len__(self):
+        return len(self._messages)
+
+    def add(self, h):
+        """Creates the node for handle h (a ghost until it gets a message); returns False if it existed."""
+        missing = h + 1 - len(self._set)
+        if missing > 0:
+            missing = max(missing, len(self._set) // 2)  # Grow geometrically, handles mostly arrive one by one
+            self._set.extend(array('i', [-1]) * missing)
+            self._size.extend(array('i', [1]) * missing)
+            self._parent.extend(array('i', [-1]) * missing)
+        if self._set[h] != -1: return False
+        self._set[h] = h
+        self._order.append(h)
+        return True
+
+    def add_message(self, h, record):
+        self.add(h)
+        self._messages[h] = record  # A later message with the same Message-ID replaces the earlier one
+
+    def messages(self):
+        return self._messages.values()
+
+    def _find(self, h):
+        s = self._set
+        while s[h] != h:
+            s[h] = s[s[h]]  # Path halving
+            h = s[h]
+        return h
+
+    def link(self, parent, child):
+        """Attaches child under parent. Returns False when child already has a parent or it would make a cycle."""
+        if parent == child or self._parent[child] != -1: return False
+        a, b = self._find(parent), self._find(child)
+        if a == b:
+            self.cycles += 1
+            if self.describe: log.debug(f"   -> Refusing cycle {self.describe(parent)} -> {self.describe(child)}")
+            return False
+        if self._size[a] < self._size[b]: a, b = b, a
+        self._set[b] = a
+        self._size[a] += self._size[b]
+        self._parent[child] = parent
+        self._links.append(child)
+        return True
+
+    def add_references(self, h, refs):
+        """JWZ step for message h: chain its References in order, then hang it under the last one."""
+        for r in refs:
+            if self.add(r): self.ghosts += 1
+        for prev, curr in zip(refs, refs[1:]):
+            if self.link(prev, curr) and self.describe:
+                log.debug(f"   -> Chaining Ref {self.describe(prev)} -> {self.describe(curr)}")
+        if refs and self.link(refs[-1], h) and self.describe:
+            log.debug(f"   -> Linking Message to Parent {self.describe(refs[-1])}")
+
+    def group_by_thread_index(self):
+        """
+        Microsoft Thread-Index: messages sharing a conversation GUID belong together even without References.
+        Each one still without a parent is attached to the previous message of its bucket by date.
+        """
+        buckets = {}
+        for h, record in self._messages.items():
+            if record.thread_index: buckets.setdefault(record.thread_index, []).append((record.epoch, h))
+        for bucket in buckets.values():
+            if len(bucket) < 2: continue
+            bucket.sort(key=lambda x: x[0])  # Stable, so equal dates keep ingest order
+            for (_, parent), (_, child) in zip(bucket, bucket[1:]):
+                if self.link(parent, child) and self.describe:
+                    log.debug(f"[DEBUG-MS-LINK] Linking via Thread-Index: {self.describe(child)} -> {self.describe(parent)}")
+
+    def threads(self):
+        """
+        Builds the display trees and yields each conversation's messages in tree pre-order,
+        conversations in the order their roots were created. Ghost-only trees are left out.
+        """
+        children = {}
+        for child in self._links: children.setdefault(self._parent[child], []).append(child)
+        for root in self._order:
+            if self._parent[root] != -1: continue
+            result, stack = [], [root]
+            while stack:
+                h = stack.pop()
+                record = self._messages.get(h)
+                if record: result.append(record)
+                kids = children.get(h)
+                if kids: stack.extend(reversed(kids))
+            if result: yield result
+
+
+# --- FULL-TEXT SEARCH INDEX ---
+
+_search_strip_blocks = re.compile(r'<(script|style)\b.*?</\1\s*>', re.S | re.I)
+_search_strip_tags = re.compile(r'<[^>]*>')
+_search_token = re.compile(r'\w{2,40}')
+
+
+def search_terms(*texts):
+    """Unique lowercase terms of the given texts, with HTML markup stripped."""
+    terms = set()
+    for text in texts:
+        if not text: continue
+        text = html.unescape(_search_strip_tags.sub(' ', _search_strip_blocks.sub(' ', text)))
+        terms.update(_search_token.findall(text.lower()))
+    return sorted(terms)
+
+
+def search_shard(term, shard_count):
+    # 32-bit FNV-1a over UTF-16 code units, mirrored by searchShard() in index.html
+    h = 0x811c9dc5
+    data = term.encode('utf-16-le')
+    for i in range(0, len(data), 2):
+        h = ((h ^ (data[i] | data[i + 1] << 8)) * 0x01000193) & 0xffffffff
+    return h % shard_count
+
+
+def to_base36(n):
+    digits = ""
+    while True:
+        n, r = divmod(n, 36)
+        digits = "0123456789abcdefghijklmnopqrstuvwxyz"[r] + digits
+        if not n: return digits
+
+
+class SearchIndex:
+    """
+    Inverted index over subject, sender and body text, keyed by message number.
+    Written as term-hashed shards of delta-encoded postings that point at conversation rows,
+    so the search box only loads the shards of the words it looks up.
+    """
 
-    if os.path.exists(output_path): shutil.rmtree(output_path)
-    data_dir = os.path.join(output_path, "data")
-    os.makedirs(data_dir)
+    def __init__(self):
+        self.postings = {}  # term -> array of message numbers
+
+    def add(self, msg_num, terms):
+        for term in terms:
+            docs = self.postings.get(term)
+            if docs is None: docs = self.postings[term] = array('I')
+            docs.append(msg_num)
+
+    def write(self, search_dir, msg_rows, writer):
+        """Writes the shards for msg_rows (message number -> row position) through writer; returns the shard count."""
+        shard_count = max(1, -(-len(self.postings) // SEARCH_TERMS_PER_SHARD))
+        shards = [[] for _ in range(shard_count)]
+        for term, docs in self.postings.items():
+            rows = sorted({msg_rows[d] for d in docs if d in msg_rows})
+            if not rows: continue
+            deltas = [rows[0]] + [b - a for a, b in zip(rows, rows[1:])]
+            shards[search_shard(term, shard_count)].append((term, ",".join(map(to_base36, deltas))))
+
+        for k, entries in enumerate(shards):
+            writer.submit(os.path.join(search_dir, f"s-{k}.js"),
+                          [f"ARCHIVE_SEARCH({k}, {json.dumps(dict(entries), ensure_ascii=False, separators=(',', ':'))});\n"])
+        return shard_count
+
+
+# --- INCREMENTAL BUILD MANIFEST ---
+
+MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS mboxes (path TEXT PRIMARY KEY, size INTEGER, mtime REAL);
+CREATE TABLE IF NOT EXISTS messages (
+    mbox TEXT, seq INTEGER, hash TEXT, meta TEXT, terms TEXT, dedup BLOB,
+    PRIMARY KEY (mbox, seq)
+);
+CREATE TABLE IF NOT EXISTS threads (signature TEXT PRIMARY KEY, tid TEXT);
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER);
+"""
 
-    # Global Lookups
-    nodes = {}  # msg_id -> Node
-    thread_index_map = {}  # thread_index_prefix -> Node (Root or parent of that thread)
-    folder_counts = {}
-    msg_counter = 0
 
-    # --- PHASE 1: INGEST AND CREATE NODES ---
-    print("\n[PHASE 1] Ingesting Messages & Extracting IDs...")
+def meta_to_json(meta):
+    return json.dumps(meta, ensure_ascii=False)
 
-    for root, _, _ in os.walk(input_path):
-        if root.endswith(".mbox") and os.path.exists(os.path.join(root, "mbox")):
-            folder_name = os.path.relpath(root, input_path).replace(".mbox", "")
-            if folder_name not in folder_counts: folder_counts[folder_name] = 0
 
-            try:
-                for msg in mailbox.mbox(os.path.join(root, "mbox")):
-                    folder_counts[folder_name] += 1
-                    msg_counter += 1
-                    local_id = f"m{msg_counter}"
-
-                    # Data Extraction
-                    subj = decode_header_safe(msg.get('subject', '(No Subject)'))
-                    date_str = decode_header_safe(msg.get('date', ''))
-                    dt_obj = parse_date_strict(date_str)
-                    mid = extract_msg_id(msg)
-                    refs = extract_references(msg)
-                    ti = extract_thread_index(msg)
-
-                    # --- DEBUG PRINT ---
-                    if msg_counter % 100 == 0: print(f"Processing {msg_counter}...")
-                    # print(f"[DEBUG] Msg: {subj[:30]}... | ID: {mid} | Refs: {len(refs)} | Thread-Index: {ti}")
-
-                    # Save Body
-                    att_dir = os.path.join(data_dir, f"{local_id}_att")
-                    body, atts = extract_content(msg, att_dir)
-
-                    # HTML Frag (Same as before)
-                    att_html = ""
-                    if atts:
-                        links = "".join([
-                                            f"<li><a href='{local_id}_att/{a['name']}' target='_blank'>{html.escape(a['name'])}</a></li>"
-                                            for a in atts if not a['is_image']])
-                        imgs = "".join([
-                                           f"<img src='{local_id}_att/{a['name']}' style='max-width:100%; border:1px solid #000; margin:10px 0;'>"
-                                           for a in atts if a['is_image']])
-                        if links: att_html += f"<div style='border:1px dashed #000; padding:10px; background:#eee; margin-bottom:10px;'><b>Attachments:</b><ul>{links}</ul></div>"
-                        if imgs: att_html += f"<div>{imgs}</div>"
-
-                    content_fragment = f"""
-                    <div class="email-container" id="{local_id}" style="border:1px solid #ccc; margin-bottom:20px;">
-                        <div class="email-header" style="background:#f4f4f4; padding:8px; border-bottom:1px solid #ddd;">
-                            <div style="float:right; font-size:11px; color:#666;">{html.escape(date_str)}</div>
-                            <div class="email-meta"><b>From:</b> {html.escape(decode_header_safe(msg.get('from', 'Unknown')))}</div>
-                            <div class="email-meta"><b>Folder:</b> {html.escape(folder_name)}</div>
-                            <div class="email-meta"><b>Subject:</b> {html.escape(subj)}</div>
-                            <div class="email-meta" style="font-size:10px; color:#999;"><b>Debug ID:</b> {mid}</div>
-                        </div>
-                        <div class="email-body" style="padding:15px;">{att_html}{body}</div>
-                    </div>
-                    """
-
-                    with open(os.path.join(data_dir, f"{local_id}.frag"), "w", encoding="utf-8") as f:
-                        f.write(content_fragment)
-
-                    # Create Node
-                    if not mid:
-                        hasher = hashlib.md5()
-                        hasher.update((subj + str(dt_obj.timestamp())).encode('utf-8'))
-                        mid = f"synth_{hasher.hexdigest()}"
-
-                    if mid not in nodes:
-                        nodes[mid] = Node(mid)
-
-                    # Store Data
-                    nodes[mid].message = {
-                        'local_id': local_id,
-                        'mid': mid,
-                        'subj': subj,
-                        'date_str': date_str,
-                        'dt': dt_obj,
-                        'sender': decode_header_safe(msg.get('from', '')),
-                        'folder': folder_name,
-                        'refs': refs,
-                        'thread_index': ti
-                    }
+def meta_from_json(text):
+    meta = json.loads(text)
+    if 'dt' in meta:  # Manifests written before dates were stored as epochs
+        dt = datetime.datetime.fromisoformat(meta.pop('dt'))
+        offset = dt.utcoffset()
+        meta['epoch'], meta['tzoff'] = int(dt.timestamp()), int(offset.total_seconds()) // 60 if offset else 0
+    return meta
+
+
+class Manifest:
+    """
+    SQLite record of the previous conversion, kept in the output dir for --incremental.
+    Stores each mbox's size and mtime, a hash per message with its metadata (including where its
+    fragment lives in the FragmentStore and the blobs it wrote), and the member signature of every thread page.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(MANIFEST_SCHEMA)
+        if 'dedup' not in [col[1] for col in self.db.execute("PRAGMA table_info(messages)")]:
+            self.db.execute("ALTER TABLE messages ADD COLUMN dedup BLOB")  # Manifests written before dedup
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def get_state(self, key, default=0):
+        row = self.db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_state(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (key, value))
+
+    def mbox_unchanged(self, mbox, st):
+        row = self.db.execute("SELECT size, mtime FROM mboxes WHERE path = ?", (mbox,)).fetchone()
+        return row is not None and row[0] == st.st_size and row[1] == st.st_mtime
+
+    def mboxes(self):
+        return [r[0] for r in self.db.execute("SELECT path FROM mboxes")]
+
+    def messages(self, mbox):
+        """Returns [(hash, meta_json, search_terms, duplicate_key)] in file order."""
+        return self.db.execute("SELECT hash, meta, terms, dedup FROM messages WHERE mbox = ? ORDER BY seq",
+                               (mbox,)).fetchall()
+
+    def replace_mbox(self, mbox, st, rows):
+        self.drop_mbox(mbox)
+        self.db.execute("INSERT INTO mboxes VALUES (?, ?, ?)", (mbox, st.st_size, st.st_mtime))
+        self.db.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+                            [(mbox, seq, *row) for seq, row in enumerate(rows)])
+
+    def drop_mbox(self, mbox):
+        self.db.execute("DELETE FROM mboxes WHERE path = ?", (mbox,))
+        self.db.execute("DELETE FROM messages WHERE mbox = ?", (mbox,))
+
+    def threads(self):
+        return dict(self.db.execute("SELECT signature, tid FROM threads"))
+
+    def replace_threads(self, threads):
+        self.db.execute("DELETE FROM threads")
+        self.db.executemany("INSERT INTO threads VALUES (?, ?)", threads.items())
+
+    def move_fragments(self, move):
+        """Replaces the fragment reference of every message with move(reference), in batches, and commits."""
+        last = 0
+        while True:
+            rows = self.db.execute("SELECT rowid, meta FROM messages WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                                   (last, CATALOG_BATCH)).fetchall()
+            if not rows: break
+            updates = []
+            for rowid, text in rows:
+                meta = meta_from_json(text)
+                meta['frag'] = move(meta['frag'])
+                updates.append((meta_to_json(meta), rowid))
+            self.db.executemany("UPDATE messages SET meta = ? WHERE rowid = ?", updates)
+            last = rows[-1][0]
+        self.db.commit()
+
+
+# --- METADATA CATALOG ---
+
+CATALOG_NAME = "catalog.sqlite"  # Next to index.html
+CATALOG_SCHEMA = """
+CREATE TABLE messages (
+    local_id TEXT PRIMARY KEY, mid TEXT, subject TEXT, sender TEXT, epoch INTEGER, tzoff INTEGER,
+    folder TEXT, thread TEXT, attachments INTEGER, attachment_bytes INTEGER
+);
+CREATE TABLE message_folders (local_id TEXT, folder TEXT);
+CREATE TABLE threads (tid TEXT PRIMARY KEY, subject TEXT, sender TEXT, epoch INTEGER, messages INTEGER, pages INTEGER);
+"""
+# Created after the bulk insert, which is much faster than keeping them up to date row by row
+CATALOG_INDEXES = """
+CREATE INDEX messages_sender ON messages (sender, epoch);
+CREATE INDEX messages_epoch ON messages (epoch);
+CREATE INDEX messages_folder ON messages (folder, epoch);
+CREATE INDEX messages_thread ON messages (thread, epoch);
+CREATE INDEX message_folders_folder ON message_folders (folder);
+CREATE INDEX message_folders_local_id ON message_folders (local_id);
+CREATE INDEX threads_epoch ON threads (epoch);
+"""
+
+
+class Catalog:
+    """
+    SQLite catalog of every message and thread of an archive, for queries by sender, date, folder or thread
+    without converting again. message_folders lists all folders of a message, including duplicate copies.
+    Rebuilt on every run in batched transactions under a temporary name, then swapped in whole.
+    """
 
+    def __init__(self, path):
+        self.path = path
+        self._tmp_path = f"{path}.tmp"
+        if os.path.exists(self._tmp_path): os.remove(self._tmp_path)
+        self.db = sqlite3.connect(self._tmp_path)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.executescript(CATALOG_SCHEMA)
+        self._messages, self._folders, self._threads = [], [], []
+
+    def add_thread(self, entry, msgs, ids):
+        """Queues a thread (its thread_entry()) and its message records; ids resolves their Message-IDs."""
+        tid = entry['tid']
+        self._threads.append((tid, entry['subj'], entry['sender'], entry['epoch'], entry['count'], entry['pages']))
+        for m in msgs:
+            self._messages.append((m.local_id, ids[m.mid], m.subj, m.sender, m.epoch, m.tzoff, m.folder, tid,
+                                   m.att_count, m.att_bytes))
+            self._folders.append((m.local_id, m.folder))
+            self._folders.extend((m.local_id, f) for f in m.dup_folders)
+        if len(self._messages) >= CATALOG_BATCH: self.flush()
+
+    def flush(self):
+        self.db.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self._messages)
+        self.db.executemany("INSERT INTO message_folders VALUES (?, ?)", self._folders)
+        self.db.executemany("INSERT INTO threads VALUES (?, ?, ?, ?, ?, ?)", self._threads)
+        self.db.commit()
+        self._messages, self._folders, self._threads = [], [], []
+
+    def close(self):
+        self.flush()
+        self.db.executescript(CATALOG_INDEXES)
+        self.db.close()
+        os.replace(self._tmp_path, self.path)
+
+
+class FragmentStore:
+    """
+    Append-only store for rendered message fragments: one segment file per process under fragment_dir.
+    A fragment is addressed by (segment, offset, length), so thread pages are assembled
+    straight from the segments instead of one small file per message.
+    """
+
+    def __init__(self, fragment_dir):
+        self.fragment_dir = fragment_dir
+        self._segment = None
+        self._segment_name = f"frag-{os.getpid()}.dat"
+        self._readers = {}
+
+    def append(self, text):
+        if self._segment is None:
+            os.makedirs(self.fragment_dir, exist_ok=True)
+            # Unbuffered, so the data is on disk even when a pool worker exits without cleanup
+            self._segment = open(os.path.join(self.fragment_dir, self._segment_name), "ab", buffering=0)
+        data = text.encode("utf-8")
+        offset = self._segment.tell()
+        self._segment.write(data)
+        return (self._segment_name, offset, len(data))
+
+    def read(self, ref):
+        segment, offset, length = ref
+        f = self._readers.get(segment)
+        if f is None:
+            f = self._readers[segment] = open(os.path.join(self.fragment_dir, segment), "rb")
+        f.seek(offset)
+        return f.read(length).decode("utf-8")
+
+    def close(self):
+        if self._segment: self._segment.close()
+        for f in self._readers.values(): f.close()
+        self._segment = None
+        self._readers.clear()
+
+
+class WriteBehind:
+    """
+    Output files handed off to writer threads through a bounded queue.
+    submit() returns as soon as there is room, so building pages never waits on filesystem latency
+    (network volumes) and at most WRITER_BACKLOG finished files are held in memory.
+    close() waits for the backlog and re-raises the first write error.
+    """
+
+    def __init__(self, threads=WRITER_THREADS, backlog=WRITER_BACKLOG):
+        self._queue = queue.Queue(backlog)
+        self._error = None
+        self._threads = [threading.Thread(target=self._drain, daemon=True) for _ in range(threads)]
+        for t in self._threads: t.start()
+
+    def submit(self, path, chunks):
+        """Queues a file given as a list of str chunks; they are streamed out one by one, never joined."""
+        if self._error: raise self._error
+        self._queue.put((path, chunks))
+
+    def _drain(self):
+        while True:
+            item = self._queue.get()
+            if item is None: return
+            path, chunks = item
+            try:
+                with open(path, "w", encoding="utf-8") as f: f.writelines(chunks)
             except Exception as e:
-                print(f"Skipping corrupt message: {e}")
+                self._error = self._error or e
 
-    # --- PHASE 2: STRICT LINKING (NO FUZZY SUBJECTS) ---
-    print("\n[PHASE 2] Linking via References & Thread-Index...")
+    def close(self):
+        for _ in self._threads: self._queue.put(None)
+        for t in self._threads: t.join()
+        if self._error: raise self._error
 
-    # 1. Standard JWZ (References)
-    # We iterate a copy to allow adding ghosts safely
-    for mid, node in list(nodes.items()):
-        if not node.message: continue
 
-        refs = node.message['refs']
+class LazyAttachments:
+    """
+    Source locations of attachments that were not decoded during conversion (--lazy-attachments).
+    Kept in data/lazy/sources.sqlite: lazy path -> (mbox, offset, length, transfer encoding).
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS sources "
+                        "(path TEXT PRIMARY KEY, mbox TEXT, offset INTEGER, length INTEGER, encoding TEXT)")
 
-        if refs:
-            print(f"[DEBUG-LINK] '{node.message['subj'][:20]}' ({mid}) has {len(refs)} refs.")
-
-            # Ensure chain exists
-            prev = None
-            for r in refs:
-                if r not in nodes:
-                    nodes[r] = Node(r)  # Create Ghost
-
-                curr = nodes[r]
-                if prev and not curr.parent and prev != curr:
-                    print(f"   -> Chaining Ref {prev.msg_id} -> {curr.msg_id}")
-                    prev.add_child(curr)
-                prev = curr
-
-            # Link current to last ref
-            last_ref = nodes[refs[-1]]
-            if last_ref != node and not node.parent:
-                print(f"   -> Linking Message to Parent {last_ref.msg_id}")
-                last_ref.add_child(node)
+    def close(self):
+        self.db.commit()
+        self.db.close()
 
-    # 2. Microsoft Thread-Index (The "Missing Data" Fix)
-    # This groups messages that share the same conversation GUID but lost their References
-    print("\n[PHASE 2.5] Linking via Thread-Index (Outlook Grouping)...")
-
-    # Bucket by Thread-Index prefix
-    ti_buckets = {}
-    for mid, node in nodes.items():
-        if node.message and node.message['thread_index']:
-            ti = node.message['thread_index']
-            if ti not in ti_buckets: ti_buckets[ti] = []
-            ti_buckets[ti].append(node)
-
-    for ti, node_list in ti_buckets.items():
-        if len(node_list) < 2: continue
-
-        # Sort by date
-        node_list.sort(key=lambda x: x.date)
-
-        # We have a list of messages that DEFINITELY belong together (cryptographically linked)
-        # If they aren't already linked via References, link them now chronologically.
-        for i in range(len(node_list) - 1):
-            parent = node_list[i]
-            child = node_list[i + 1]
-
-            # Only link if child is orphan (or we are repairing a broken tree)
-            if not child.parent and child != parent:
-                # Check if they are already in the same tree?
-                # Actually, if they share a TI, they ARE the same thread.
-                # If 'child' has no parent, attach to 'parent'.
-                print(
-                    f"[DEBUG-MS-LINK] Linking via Thread-Index: {child.message['subj'][:20]} -> {parent.message['subj'][:20]}")
-                parent.add_child(child)
+    def add(self, rows):
+        self.db.executemany("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?)", rows)
 
-    # --- PHASE 3: REMOVED (NO SUBJECT MERGING) ---
-    print("\n[PHASE 3] Subject Merging DISABLED (Preventing 'Stacking')...")
+    def get(self, rel_path):
+        return self.db.execute("SELECT mbox, offset, length, encoding FROM sources WHERE path = ?",
+                               (rel_path,)).fetchone()
 
-    # --- PHASE 4: FLATTEN & SORT ---
-    print("\n[PHASE 4] Generating Thread Views...")
+    def paths(self):
+        return [r[0] for r in self.db.execute("SELECT path FROM sources ORDER BY path")]
 
-    final_roots = [n for n in nodes.values() if n.parent is None]
-    final_threads = []
-    thread_id_counter = 0
 
-    for root in final_roots:
-        msgs = root.walk()
-        if not msgs: continue
+def load_lazy_source(rel_path, mbox, offset, length, encoding):
+    """Reads and decodes a lazy attachment from its mbox; None when the source is gone or has changed."""
+    try:
+        with open(mbox, "rb") as f:
+            f.seek(offset)
+            raw = f.read(length)
+    except OSError:
+        return None
+    # The lazy name is the hash of the encoded bytes, so a moved or rewritten source is caught here
+    if blob_path("lazy", hashlib.sha256(raw).hexdigest(), rel_path) != rel_path: return None
+    return decode_payload(raw, encoding)
+
 
-        msgs.sort(key=lambda x: x['dt'])
+def write_lazy_source(path, rel_path, mbox, offset, length, encoding):
+    """
+    load_lazy_source() straight into the file at path, decoded piece by piece from a map of the mbox,
+    so an attachment of any size is never held in memory. False when the source is gone or has changed.
+    """
+    try:
+        with open(mbox, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            end = offset + length
+            if end > len(buf): return False
+            if blob_path("lazy", hash_range(hashlib.sha256(), buf, offset, end).hexdigest(), rel_path) != rel_path:
+                return False
+            try:
+                write_file_atomic(path, iter_decoded(buf, offset, end, encoding))
+            except binascii.Error:
+                write_file_atomic(path, [b""])  # As decode_payload() gives for base64 beyond repair
+    except (OSError, ValueError):
+        return False
+    return True
 
-        folders = set(m['folder'] for m in msgs)
-        folders_str = "||".join(sorted(folders))
 
-        latest_msg = msgs[-1]
-        thread_id_counter += 1
-        tid = f"t{thread_id_counter}"
+def materialize_attachments(output_path):
+    """
+    Writes every lazy attachment of an archive that is not on disk yet into data/lazy/.
+    Returns (written, failed) counts.
+    """
+    data_dir = os.path.join(output_path, "data")
+    table_path = os.path.join(data_dir, LAZY_TABLE)
+    if not os.path.exists(table_path): return 0, 0
+    table = LazyAttachments(table_path)
+    written = failed = 0
+    try:
+        for rel_path in table.paths():
+            path = os.path.join(data_dir, rel_path)
+            if os.path.exists(path): continue
+            row = table.get(rel_path)
+            if row is None or not write_lazy_source(path, rel_path, *row):
+                log.warning(f"Cannot materialize {rel_path}: its source mbox is missing or has changed")
+                failed += 1
+                continue
+            written += 1
+    finally:
+        table.close()
+    return written, failed
 
-        html_content = ""
-        for m in msgs:
-            fpath = os.path.join(data_dir, f"{m['local_id']}.frag")
-            if os.path.exists(fpath):
-                with open(fpath, "r", encoding="utf-8") as f:
-                    html_content += f.read()
-
-        full_html = f"""
-        <!DOCTYPE html><html><head><meta charset="UTF-8">
-        <style>
-            body {{ font-family: "Geneva", sans-serif; padding: 20px; font-size: 14px; background: #fff; }}
-            pre {{ white-space: pre-wrap; font-family: Courier; }}
-            img {{ max-width: 100%; height: auto; }}
-        </style>
-        </head><body>
-        <h2 style='border-bottom: 2px solid black; padding-bottom:10px;'>Topic: {html.escape(latest_msg['subj'])}</h2>
-        {html_content}
-        </body></html>
-        """
 
-        with open(os.path.join(data_dir, f"{tid}.html"), "w", encoding="utf-8") as f:
-            f.write(full_html)
-
-        final_threads.append({
-            'tid': tid,
-            'subj': latest_msg['subj'],
-            'sender': latest_msg['sender'],
-            'date_str': latest_msg['date_str'],
-            'sort_dt': latest_msg['dt'],
-            'folders': folders_str,
-            'count': len(msgs)
-        })
+# --- MESSAGE EXTRACTION (runs in worker processes with --jobs) ---
 
-    final_threads.sort(key=lambda x: x['sort_dt'], reverse=True)
+_open_readers = OrderedDict()  # mbox path -> MboxReader, the READER_CACHE_SIZE most recently used per process
+_open_stores = {}  # fragment dir -> FragmentStore, cached per process
 
-    # --- PHASE 5: INDEX HTML ---
-    folder_html = "".join(
-        [f'<div class="folder-item" onclick="filterFolder(\'{f}\')"><span>{f}</span><span>{c}</span></div>' for f, c in
-         sorted(folder_counts.items())])
-
-    rows_html = ""
-    for t in final_threads:
-        # FIXED: Date format to YYYY-MM-DD HH:MM
-        formatted_date = t['sort_dt'].strftime('%Y-%m-%d %H:%M')
-
-        # FIXED: Badge placed before topic
-        badge = f'<span class="thread-count">{t["count"]}</span>' if t["count"] > 1 else ""
-
-        rows_html += f"""
-        <div class="mail-row" data-folders="{html.escape(t['folders'])}" onclick="loadEmail('data/{t['tid']}.html', this)">
-            <div class="mail-row-header">
-                <div class="mail-row-sender">{html.escape(t['sender'][:30])}</div>
-                <div class="mail-row-date">{formatted_date}</div>
-            </div>
-            <div class="mail-row-subject">
-                {badge}{html.escape(t['subj'])}
+
+def _reader_for(path):
+    # Callers finish with one message before asking for the next reader, so evicting the oldest map is safe
+    reader = _open_readers.get(path)
+    if reader is None:
+        reader = _open_readers[path] = MboxReader(path)
+        if len(_open_readers) > READER_CACHE_SIZE: _open_readers.popitem(last=False)[1].close()
+    else:
+        _open_readers.move_to_end(path)
+    return reader
+
+
+def _store_for(fragment_dir):
+    store = _open_stores.get(fragment_dir)
+    if store is None:
+        store = _open_stores[fragment_dir] = FragmentStore(fragment_dir)
+    return store
+
+
+def close_worker_files():
+    for reader in _open_readers.values(): reader.close()
+    for store in _open_stores.values(): store.close()
+    _open_readers.clear()
+    _open_stores.clear()
+
+
+def message_meta(msg, local_id, folder_name):
+    """Decodes the headers of a RawMessage (each of them once) into the metadata dict of a message."""
+    date_str = decode_header_safe(msg.get('date', ''))
+    epoch, tzoff = parse_date(date_str)
+    return {
+        'local_id': local_id,
+        'mid': extract_msg_id(msg),
+        'subj': decode_header_safe(msg.get('subject', '(No Subject)')),
+        'date_str': date_str,
+        'epoch': epoch,
+        'tzoff': tzoff,
+        'sender': decode_header_safe(msg.get('from') or ''),
+        'folder': folder_name,
+        'refs': extract_references(msg),
+        'thread_index': extract_thread_index(msg)
+    }
+
+
+def synthetic_mid(meta):
+    """Stand-in Message-ID for messages without one, from their subject and date."""
+    hasher = hashlib.md5()
+    hasher.update((meta['subj'] + str(float(meta['epoch']))).encode('utf-8'))
+    return f"synth_{hasher.hexdigest()}"
+
+
+def render_fragment(msg, meta, body, atts):
+    """The HTML of one message as it appears in a thread page."""
+    att_html = ""
+    if atts:
+        links = "".join([
+                            f"<li><a href='{a['path']}' download='{html.escape(a['name'])}' target='_blank'>{html.escape(a['name'])}</a></li>"
+                            for a in atts if not a['is_image'] and not a.get('inline')])
+        imgs = "".join([
+                           f"<img src='{a['path']}' style='max-width:100%; border:1px solid #000; margin:10px 0;'>"
+                           for a in atts if a['is_image'] and not a.get('inline')])  # Inline ones are in the body
+        if links: att_html += f"<div style='border:1px dashed #000; padding:10px; background:#eee; margin-bottom:10px;'><b>Attachments:</b><ul>{links}</ul></div>"
+        if imgs: att_html += f"<div>{imgs}</div>"
+
+    return f"""
+        <div class="email-container" id="{meta['local_id']}" style="border:1px solid #ccc; margin-bottom:20px;">
+            <div class="email-header" style="background:#f4f4f4; padding:8px; border-bottom:1px solid #ddd;">
+                <div style="float:right; font-size:11px; color:#666;">{html.escape(meta['date_str'])}</div>
+                <div class="email-meta"><b>From:</b> {html.escape(meta['sender'] if msg.get('from') is not None else 'Unknown')}</div>
+                <div class="email-meta"><b>Folder:</b> {html.escape(meta['folder'])}</div>
+                <div class="email-meta"><b>Subject:</b> {html.escape(meta['subj'])}</div>
+                <div class="email-meta" style="font-size:10px; color:#999;"><b>Debug ID:</b> {meta['mid']}</div>
             </div>
+            <div class="email-body" style="padding:15px;">{att_html}{body}</div>
         </div>
         """
 
+
+def extract_message(data_dir, fragment_dir, lazy, task):
+    """
+    Extracts one message given as (mbox_path, start, end, local_id, folder_name).
+    Writes its attachments (or, with lazy, only locates them) and appends its HTML fragment
+    to the FragmentStore, then returns only the metadata dict for MessageRecord.
+    """
+    mbox_path, start, end, local_id, folder_name = task
+    try:
+        msg = RawMessage(_reader_for(mbox_path).buf, start, end)
+        meta = message_meta(msg, local_id, folder_name)
+
+        # Save Body
+        body, atts = extract_content(msg.buf, start, end, data_dir, lazy)
+        meta['frag'] = _store_for(fragment_dir).append(render_fragment(msg, meta, body, atts))
+
+        if not meta['mid']: meta['mid'] = synthetic_mid(meta)
+        meta.update({
+            'att_count': len(atts),
+            'att_bytes': sum(a['size'] for a in atts),  # Encoded size for lazy attachments
+            'att_bytes_written': sum(a['size'] for a in atts if a['written']),
+            'lazy': [[a['path'], *a['source']] for a in atts if 'source' in a],
+            'blobs': sorted({a['path'] for a in atts if 'source' not in a}),  # For --incremental cleanup
+            'terms': search_terms(meta['subj'], meta['sender'], body)
+        })
+        return meta
+    except Exception as e:
+        log.warning(f"Skipping corrupt message {local_id}: {e}")
+        return None
+
+
+# --- THREAD PAGES ---
+
+THREAD_PAGE_HEAD = """
+            <!DOCTYPE html><html><head><meta charset="UTF-8">
+            <style>
+                body {{ font-family: "Geneva", sans-serif; padding: 20px; font-size: 14px; background: #fff; }}
+                pre {{ white-space: pre-wrap; font-family: Courier; }}
+                img {{ max-width: 100%; height: auto; }}
+            </style>
+            </head><body>
+            <h2 style='border-bottom: 2px solid black; padding-bottom:10px;'>Topic: {subject}</h2>
+            """
+THREAD_PAGE_FOOT = """
+            </body></html>
+            """
+
+
+def paginate(msgs, page_size, page_bytes, sizes=None):
+    """
+    Splits a thread into pages of at most page_size messages and page_bytes of fragments (0 = no limit).
+    Fragment sizes come from sizes (record num -> bytes) when given, else from the FragmentStore reference.
+    """
+    pages, page, size = [], [], 0
+    for m in msgs:
+        length = sizes[m.num] if sizes else m.frag[2]  # Nothing is read either way
+        if page and ((page_size and len(page) >= page_size) or (page_bytes and size + length > page_bytes)):
+            pages.append(page)
+            page, size = [], 0
+        page.append(m)
+        size += length
+    pages.append(page)
+    return pages
+
+
+def page_name(tid, k):
+    return f"{tid}.html" if k == 0 else f"{tid}_p{k + 1}.html"
+
+
+def thread_page(tid, subject, pages, k, render):
+    """
+    Chunks of page k of a thread, with render(record) giving each message's HTML. A single page is the
+    classic t{N}.html; a split thread gets prev/next links on every page and a header list of all its
+    messages on the first one, so only the page being read has to be loaded.
+    """
+    head = THREAD_PAGE_HEAD.format(subject=html.escape(subject))
+    if len(pages) == 1: return [head] + [render(m) for m in pages[0]] + [THREAD_PAGE_FOOT]
+
+    links = [f"<a href='{page_name(tid, 0)}'>&laquo; First</a>",
+             f"<a href='{page_name(tid, k - 1)}'>&lsaquo; Prev</a>" if k else "&lsaquo; Prev",
+             f"<b>Page {k + 1} of {len(pages)}</b>",
+             f"<a href='{page_name(tid, k + 1)}'>Next &rsaquo;</a>" if k + 1 < len(pages) else "Next &rsaquo;",
+             f"<a href='{page_name(tid, len(pages) - 1)}'>Last &raquo;</a>"]
+    nav = f"<div class='thread-nav' style='margin:10px 0; font-size:12px;'>{' | '.join(links)}</div>"
+    chunks = [head, nav]
+    if k == 0:
+        chunks.append("<table class='thread-list' style='width:100%; border-collapse:collapse; "
+                      "font-size:12px; margin-bottom:20px;'>")
+        for n, other in enumerate(pages):
+            chunks.extend(f"<tr><td style='white-space:nowrap; padding:2px 8px 2px 0;'>{format_epoch(m.epoch, m.tzoff)}</td>"
+                          f"<td style='padding:2px 8px 2px 0;'>{html.escape(m.sender[:40])}</td>"
+                          f"<td><a href='{page_name(tid, n)}#{m.local_id}'>{html.escape(m.subj)}</a></td></tr>"
+                          for m in other)
+        chunks.append("</table>")
+    chunks.extend(render(m) for m in pages[k])
+    chunks += [nav, THREAD_PAGE_FOOT]
+    return chunks
+
+
+def thread_entry(tid, msgs, page_count):
+    """The index row of a thread whose messages are sorted by date: named after its latest message."""
+    folders = set(m.folder for m in msgs)
+    for m in msgs: folders.update(m.dup_folders)
+    latest_msg = msgs[-1]
+    return {
+        'tid': tid,
+        'subj': latest_msg.subj,
+        'sender': latest_msg.sender,
+        'epoch': latest_msg.epoch,
+        'tzoff': latest_msg.tzoff,
+        'folders': "||".join(sorted(folders)),
+        'count': len(msgs),
+        'pages': page_count,
+        'members': [m.num for m in msgs]
+    }
+
+
+def remove_thread_pages(data_dir, tids):
+    """Deletes every page (t{N}.html and t{N}_p{k}.html) of the given threads with one directory scan."""
+    if not tids: return
+    for name in os.listdir(data_dir):
+        if name.endswith(".html") and name[:-5].split("_p")[0] in tids:
+            os.remove(os.path.join(data_dir, name))
+
+
+def remove_dead_blobs(data_dir, live):
+    """Deletes every file under data/blobs/ whose path is not in live; returns how many went."""
+    removed = 0
+    for root, _, files in os.walk(os.path.join(data_dir, "blobs")):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.relpath(path, data_dir).replace(os.sep, "/") not in live:
+                os.remove(path)
+                removed += 1
+    return removed
+
+
+def compact_fragments(fragment_dir, manifest, live_bytes):
+    """
+    Reclaims fragments that no message uses any more, given the live bytes per segment. Segments without
+    any are deleted; once dead bytes pass FRAGMENT_DEAD_RATIO of the store, the live fragments are copied
+    into one new segment and the manifest is pointed at it first. Returns the bytes reclaimed.
+    """
+    segments = {name: os.path.getsize(os.path.join(fragment_dir, name)) for name in os.listdir(fragment_dir)
+                if name.startswith("frag-") and name.endswith(".dat")} if os.path.isdir(fragment_dir) else {}
+    total = sum(segments.values())
+    keep, written = set(live_bytes), 0
+    if total - sum(live_bytes.values()) > total * FRAGMENT_DEAD_RATIO:
+        fd, new_path = tempfile.mkstemp(prefix="frag-", suffix=".dat", dir=fragment_dir)
+        new_name = os.path.basename(new_path)
+        moved, sources = {}, {}  # (segment, offset) -> new reference; segment -> open file
+        with os.fdopen(fd, "wb") as out:
+            def move(ref):
+                segment, offset, length = ref
+                if (segment, offset) not in moved:
+                    f = sources.get(segment)
+                    if f is None: f = sources[segment] = open(os.path.join(fragment_dir, segment), "rb")
+                    f.seek(offset)
+                    moved[segment, offset] = [new_name, out.tell(), length]
+                    out.write(f.read(length))
+                return moved[segment, offset]
+            try:
+                manifest.move_fragments(move)  # Committed before any old segment goes
+            finally:
+                for f in sources.values(): f.close()
+            written = out.tell()
+        keep = {new_name}
+    reclaimed = -written
+    for name, size in segments.items():
+        if name not in keep:
+            os.remove(os.path.join(fragment_dir, name))
+            reclaimed += size
+    return reclaimed
+
+
+def iter_mboxes(input_path):
+    """Yields (folder name, mbox path) for every .mbox folder of an Apple Mail export."""
+    for root, _, _ in os.walk(input_path):
+        if root.endswith(".mbox") and os.path.exists(os.path.join(root, "mbox")):
+            yield os.path.relpath(root, input_path).replace(".mbox", ""), os.path.join(root, "mbox")
+
+
+def link_messages(engine, ids, metrics):
+    """Phases 2 and 2.5: links the merged messages by References, then by Thread-Index."""
+    metrics.begin('link')
+    log.info("[PHASE 2] Linking via References & Thread-Index...")
+    debug = log.isEnabledFor(logging.DEBUG)  # Checked once, so the debug chatter costs nothing when off
+    if debug: engine.describe = ids.__getitem__
+
+    # 1. Standard JWZ (References)
+    for record in engine.messages():
+        refs = record.refs
+        record.refs = None
+        if refs:
+            if debug: log.debug(f"[DEBUG-LINK] '{record.subj[:20]}' ({ids[record.mid]}) has {len(refs)} refs.")
+            engine.add_references(record.mid, refs)
+    metrics.count('ghost_nodes', engine.ghosts)
+
+    # 2. Microsoft Thread-Index (The "Missing Data" Fix)
+    # This groups messages that share the same conversation GUID but lost their References
+    metrics.begin('thread_index')
+    log.info("[PHASE 2.5] Linking via Thread-Index (Outlook Grouping)...")
+    engine.group_by_thread_index()
+    metrics.count('refused_cycles', engine.cycles)
+
+
+def write_index(output_path, title, final_threads, folder_counts, search_index, writer):
+    """
+    Phase 5: submits index.html, the thread list shards, the folder index and the search shards to writer.
+    The thread list is written as JS shards (loadable from file://) and rendered by a virtual list,
+    so index.html stays small and the browser only builds DOM for the rows on screen.
+    Returns the number of search shards.
+    """
+    index_dir = os.path.join(output_path, "data", "index")
+
+    folder_rows = {f: [] for f in folder_counts}  # folder -> row positions, precomputed for filterFolder
+    for start in range(0, len(final_threads), INDEX_SHARD_SIZE):
+        shard = []
+        for pos, t in enumerate(final_threads[start:start + INDEX_SHARD_SIZE], start):
+            # FIXED: Date format to YYYY-MM-DD HH:MM
+            shard.append([t['tid'], t['sender'][:30], format_epoch(t['epoch'], t['tzoff']), t['subj'], t['count']])
+            for f in t['folders'].split("||"): folder_rows.setdefault(f, []).append(pos)
+        writer.submit(os.path.join(index_dir, f"threads-{start // INDEX_SHARD_SIZE}.js"),
+                      [f"ARCHIVE_SHARD({start // INDEX_SHARD_SIZE}, {json.dumps(shard, ensure_ascii=False, separators=(',', ':'))});\n"])
+
+    # Row positions are delta-encoded to keep the folder index small
+    folder_index = {f: [p - q for p, q in zip(rows, [0] + rows[:-1])] for f, rows in folder_rows.items()}
+    writer.submit(os.path.join(index_dir, "folders.js"),
+                  [f"ARCHIVE_FOLDERS = {json.dumps(folder_index, ensure_ascii=False, separators=(',', ':'))};\n"])
+
+    msg_rows = {num: pos for pos, t in enumerate(final_threads) for num in t['members']}
+    search_shards = search_index.write(os.path.join(output_path, "data", "search"), msg_rows, writer)
+
+    folder_html = "".join(
+        [f'<div class="folder-item" data-folder="{html.escape(f)}" onclick="filterFolder(this.dataset.folder, this)">'
+         f'<span>{html.escape(f)}</span><span>{c}</span></div>' for f, c in sorted(folder_counts.items())])
+
     index_html = f"""
     <!DOCTYPE html>
     <html>
     <head><meta charset="UTF-8"><title>Mail Archive</title>{RETRO_CSS}</head>
     <body>
         <div class="window">
-            <div class="title-bar"><div class="title-text">{original_folder_name} Archive - {len(final_threads)} Conversations</div></div>
+            <div class="title-bar"><div class="title-text">{html.escape(title)} Archive - {len(final_threads)} Conversations</div></div>
             <div class="main-view">
                 <div class="sidebar">
-                    <div class="folder-item active" onclick="filterFolder('all')"><span>All Mailboxes</span><span>{sum(folder_counts.values())}</span></div>
+                    <input class="search-box" id="searchBox" type="search" placeholder="Search" oninput="scheduleSearch()">
+                    <div class="folder-item active" onclick="filterFolder(null, this)"><span>All Mailboxes</span><span>{sum(folder_counts.values())}</span></div>
                     {folder_html}
                 </div>
                 <div class="list-pane" id="emailList">
-                    {rows_html}
+                    <div class="list-spacer" id="listSpacer"></div>
+                    <div class="list-rows" id="listRows"></div>
                 </div>
                 <div class="preview-pane">
                     <div id="placeholder" class="preview-placeholder">Select a conversation</div>
@@ -583,39 +1753,854 @@ def main():
                 </div>
             </div>
         </div>
+        <script src="data/index/folders.js"></script>
         <script>
-            function filterFolder(folderName) {{
-                document.querySelectorAll('.folder-item').forEach(el => el.classList.remove('active'));
-                event.currentTarget.classList.add('active');
-
-                const rows = document.querySelectorAll('.mail-row');
-                rows.forEach(row => {{
-                    const rowFolders = row.getAttribute('data-folders').split('||');
-                    if (folderName === 'all' || rowFolders.includes(folderName)) {{
-                        row.style.display = 'flex';
+            const TOTAL = {len(final_threads)}, SHARD_SIZE = {INDEX_SHARD_SIZE}, ROW_HEIGHT = {INDEX_ROW_HEIGHT};
+            const SEARCH_SHARDS = {search_shards};
+            const shards = {{}}, requested = {{}}, folderViews = {{}};
+            const searchShards = {{}}, searchWaiting = [];
+            let folderViewActive = null, searchTimer = null;
+            const list = document.getElementById('emailList');
+            let view = null;  // Row positions of the active folder, null = all
+            let selectedTid = null;
+
+            function ARCHIVE_SHARD(k, rows) {{ shards[k] = rows; render(); }}
+
+            function loadShard(k) {{
+                if (requested[k]) return;
+                requested[k] = true;
+                const s = document.createElement('script');
+                s.src = 'data/index/threads-' + k + '.js';
+                document.head.appendChild(s);
+            }}
+
+            function folderView(name) {{
+                if (!folderViews[name]) {{
+                    let pos = 0;
+                    folderViews[name] = (ARCHIVE_FOLDERS[name] || []).map(d => pos += d);
+                }}
+                return folderViews[name];
+            }}
+
+            function makeRow(t) {{
+                const row = document.createElement('div');
+                row.className = 'mail-row' + (t[0] === selectedTid ? ' selected' : '');
+                row.onclick = () => loadEmail(t[0], row);
+                const header = row.appendChild(document.createElement('div'));
+                header.className = 'mail-row-header';
+                const sender = header.appendChild(document.createElement('div'));
+                sender.className = 'mail-row-sender';
+                sender.textContent = t[1];
+                const date = header.appendChild(document.createElement('div'));
+                date.className = 'mail-row-date';
+                date.textContent = t[2];
+                const subject = row.appendChild(document.createElement('div'));
+                subject.className = 'mail-row-subject';
+                // FIXED: Badge placed before topic
+                if (t[4] > 1) {{
+                    const badge = subject.appendChild(document.createElement('span'));
+                    badge.className = 'thread-count';
+                    badge.textContent = t[4];
+                }}
+                subject.appendChild(document.createTextNode(t[3]));
+                return row;
+            }}
+
+            function render() {{
+                const count = view ? view.length : TOTAL;
+                const first = Math.max(0, Math.floor(list.scrollTop / ROW_HEIGHT) - 10);
+                const last = Math.min(count, Math.ceil((list.scrollTop + list.clientHeight) / ROW_HEIGHT) + 10);
+                document.getElementById('listSpacer').style.height = (count * ROW_HEIGHT) + 'px';
+                const rows = document.getElementById('listRows');
+                rows.style.transform = 'translateY(' + (first * ROW_HEIGHT) + 'px)';
+                rows.textContent = '';
+                for (let i = first; i < last; i++) {{
+                    const pos = view ? view[i] : i;
+                    const shard = shards[Math.floor(pos / SHARD_SIZE)];
+                    if (shard) {{
+                        rows.appendChild(makeRow(shard[pos % SHARD_SIZE]));
                     }} else {{
-                        row.style.display = 'none';
+                        loadShard(Math.floor(pos / SHARD_SIZE));
+                        const row = rows.appendChild(document.createElement('div'));
+                        row.className = 'mail-row';
+                        row.textContent = '…';
+                    }}
+                }}
+            }}
+
+            function filterFolder(folderName, el) {{
+                document.querySelectorAll('.folder-item').forEach(item => item.classList.remove('active'));
+                el.classList.add('active');
+                view = folderViewActive = folderName === null ? null : folderView(folderName);
+                document.getElementById('searchBox').value = '';
+                list.scrollTop = 0;
+                render();
+            }}
+
+            // --- Search: postings shards are loaded on demand, rows of all query terms are intersected ---
+            function searchShard(term) {{
+                let h = 0x811c9dc5;
+                for (let i = 0; i < term.length; i++) h = Math.imul(h ^ term.charCodeAt(i), 0x01000193) >>> 0;
+                return h % SEARCH_SHARDS;
+            }}
+
+            function ARCHIVE_SEARCH(k, postings) {{
+                searchShards[k] = postings;
+                searchWaiting.splice(0).forEach(fn => fn());
+            }}
+
+            function withSearchShards(keys, fn) {{
+                const missing = keys.filter(k => !searchShards[k]);
+                if (!missing.length) return fn();
+                searchWaiting.push(() => withSearchShards(keys, fn));
+                missing.forEach(k => {{
+                    if (requested['s' + k]) return;
+                    requested['s' + k] = true;
+                    const s = document.createElement('script');
+                    s.src = 'data/search/s-' + k + '.js';
+                    document.head.appendChild(s);
+                }});
+            }}
+
+            function postingRows(text) {{
+                let pos = 0;
+                return text ? text.split(',').map(d => pos += parseInt(d, 36)) : [];
+            }}
+
+            function scheduleSearch() {{
+                clearTimeout(searchTimer);
+                searchTimer = setTimeout(runSearch, 200);
+            }}
+
+            function runSearch() {{
+                const query = document.getElementById('searchBox').value;
+                const terms = [...new Set(query.toLowerCase().match(/[\\p{{L}}\\p{{N}}_]{{2,40}}/gu) || [])];
+                if (!terms.length) {{
+                    view = folderViewActive;
+                    list.scrollTop = 0;
+                    return render();
+                }}
+                withSearchShards([...new Set(terms.map(searchShard))], () => {{
+                    if (document.getElementById('searchBox').value !== query) return;
+                    let rows = null;
+                    for (const term of terms) {{
+                        const found = postingRows(searchShards[searchShard(term)][term]);
+                        if (rows === null) {{
+                            rows = found;
+                        }} else {{
+                            const keep = new Set(found);
+                            rows = rows.filter(r => keep.has(r));
+                        }}
+                    }}
+                    if (folderViewActive) {{
+                        const inFolder = new Set(folderViewActive);
+                        rows = rows.filter(r => inFolder.has(r));
                     }}
+                    view = rows;
+                    list.scrollTop = 0;
+                    render();
                 }});
             }}
-            function loadEmail(url, el) {{
+
+            function loadEmail(tid, el) {{
+                selectedTid = tid;
                 document.querySelectorAll('.mail-row').forEach(row => row.classList.remove('selected'));
                 el.classList.add('selected');
                 document.getElementById('placeholder').style.display = 'none';
                 const frame = document.getElementById('previewFrame');
                 frame.style.display = 'block';
-                frame.src = url;
+                frame.src = 'data/' + tid + '.html';
             }}
+
+            list.addEventListener('scroll', () => requestAnimationFrame(render));
+            window.addEventListener('resize', render);
+            render();
         </script>
     </body>
     </html>
     """
 
-    with open(os.path.join(output_path, "index.html"), "w", encoding="utf-8") as f:
-        f.write(index_html)
+    writer.submit(os.path.join(output_path, "index.html"), [index_html])
+    return search_shards
+
+
+def convert(input_path, output_path, jobs=1, pool=None, incremental=False, low_memory=False, lazy=False,
+            thread_page_size=THREAD_PAGE_SIZE, thread_page_bytes=THREAD_PAGE_BYTES):
+    """
+    Converts one Apple Mail export into an archive at output_path.
+    Extraction runs on pool when given (shared between exports). With low_memory, Message-IDs are kept
+    in an on-disk table instead of memory. With lazy, attachments are only located, not decoded
+    (see materialize_attachments). Threads beyond thread_page_size messages or thread_page_bytes
+    are split into pages. Returns the run summary dict; its ok is false when an mbox could not be read.
+    """
+    metrics = Metrics()
+    original_folder_name = os.path.basename(input_path.rstrip(os.sep))
+
+    build_dir = os.path.join(output_path, ".build")
+    manifest_path = os.path.join(build_dir, "manifest.sqlite")
+    if os.path.exists(output_path) and not (incremental and os.path.exists(manifest_path)):
+        shutil.rmtree(output_path)
+    data_dir = os.path.join(output_path, "data")
+    fragment_dir = os.path.join(build_dir, "fragments")
+    os.makedirs(data_dir, exist_ok=True)
+    os.makedirs(build_dir, exist_ok=True)
+    manifest = Manifest(manifest_path) if incremental else None
+
+    # Global Lookups
+    engine = ThreadingEngine()
+    ids = StringTable(os.path.join(build_dir, "ids.sqlite") if low_memory else None)
+    folder_counts = {}
+    search_index = SearchIndex()
+    msg_counter = manifest.get_state('msg_counter') if manifest else 0
 
-    print(f"Done! Created STRICT archive at: {output_path}")
+    # --- PHASE 1: INGEST AND CREATE NODES ---
+    metrics.begin('ingest')
+    log.info("[PHASE 1] Ingesting Messages & Extracting IDs...")
+
+    # 1a. Split every mbox into byte ranges. Local IDs are assigned here, in file order,
+    # so they do not depend on how many workers run the extraction.
+    # With --incremental, unchanged mboxes and known messages reuse their manifest entries instead.
+    # A copy of a message already seen in another folder (same duplicate_key) is not extracted again.
+    tasks = []
+    entries = []  # Per message in file order: [hash, meta_json, search_terms, duplicate key,
+    #               task index or None, (mbox, start) or None, folder if it is a duplicate copy or None]
+    seen_keys = set()
+    mbox_entries = {}  # mbox (relative) -> (stat, entries) for mboxes that have to be rewritten in the manifest
+    seen_mboxes = set()
+
+    # Mboxes are cut into chunks at message boundaries and scanned on the pool (largest first), then merged
+    # below in file order, so one huge mbox is split across workers and the result matches a sequential run.
+    plan = []  # Per mbox in walk order: (folder, mbox path, mbox key, manifest rows if unchanged, known, chunks)
+    for folder_name, mbox_path in iter_mboxes(input_path):
+        if folder_name not in folder_counts: folder_counts[folder_name] = 0
+
+        mbox_key = os.path.relpath(mbox_path, input_path)
+        metrics.count('mbox_bytes', os.path.getsize(mbox_path))
+        known = {}
+        if manifest:
+            seen_mboxes.add(mbox_key)
+            st = os.stat(mbox_path)
+            old_rows = manifest.messages(mbox_key)
+            if manifest.mbox_unchanged(mbox_key, st):
+                plan.append((folder_name, mbox_path, mbox_key, old_rows, None, []))
+                continue
+            for row in old_rows: known.setdefault(row[0], []).append(row)
+            mbox_entries[mbox_key] = (st, [])
+        plan.append((folder_name, mbox_path, mbox_key, None, known, plan_chunks(mbox_path, SCAN_CHUNK_BYTES)))
+
+    scanned = scan_mboxes([c for *_, chunks in plan for c in chunks], manifest is not None, pool)
+
+    for folder_name, mbox_path, mbox_key, old_rows, known, chunks in plan:
+        if old_rows is not None:
+            folder_counts[folder_name] += len(old_rows)
+            entries.extend(list(row) + [None, None, None] for row in old_rows)
+            seen_keys.update(row[3] for row in old_rows if row[3])
+            continue
+        results = [scanned.pop(c) for c in chunks]
+        if None in results:
+            log.warning(f"Skipping unreadable mbox {mbox_path}")
+            metrics.count('skipped_mboxes')
+            mbox_entries.pop(mbox_key, None)  # Stays stale in the manifest, so the next run tries again
+            continue
+        for start, end, key, h in (m for result in results for m in result):
+            folder_counts[folder_name] += 1
+            if known.get(h):
+                entry = list(known[h].pop(0)) + [None, (mbox_path, start), None]
+            elif key in seen_keys:
+                entry = [h, None, None, key, None, (mbox_path, start), folder_name]
+            else:
+                msg_counter += 1
+                tasks.append((mbox_path, start, end, f"m{msg_counter}", folder_name))
+                entry = [h, None, None, key, len(tasks) - 1, (mbox_path, start), None]
+            if entry[3]: seen_keys.add(entry[3])
+            entries.append(entry)
+            if manifest: mbox_entries[mbox_key][1].append(entry)
+    del plan, scanned
+
+    if manifest:
+        for mbox_key in manifest.mboxes():
+            if mbox_key not in seen_mboxes: manifest.drop_mbox(mbox_key)
+        reused = sum(1 for e in entries if e[4] is None and e[6] is None)
+        metrics.count('reused_messages', reused)
+        log.info(f"Reusing {reused} messages, extracting {len(tasks)} new or changed.")
+
+    # 1b. Extract bodies, attachments and fragments (in parallel with --jobs)
+    # With a pool everything goes through it, even a single task: the readers and stores of this process
+    # are shared by every export converting alongside, so only a pool-less run may close them afterwards.
+    worker = functools.partial(extract_message, data_dir, fragment_dir, lazy)
+    if pool is not None:
+        chunksize = max(1, min(256, len(tasks) // (jobs * 8)))
+        extracted = pool.map(worker, tasks, chunksize=chunksize)
+    else:
+        extracted = map(worker, tasks)
+
+    # 1c. Merge in file order so the node graph is identical for any --jobs. Entries reach the tasks in order,
+    # so results are taken as they come back and each meta is dropped once its record is built.
+    lazy_table = LazyAttachments(os.path.join(data_dir, LAZY_TABLE)) if lazy else None
+    live_blobs, live_fragments = set(), {}  # With --incremental, what the kept messages still use
+    untracked = 0  # Messages from manifests that did not record their blobs yet
+    canonical = {}  # duplicate key -> (entry, record) of the first copy, which represents all of them
+    for entry in entries:
+        if entry[4] is not None:
+            extracted_meta = next(extracted)
+            metrics.progress(entry[4] + 1, len(tasks))
+        key, dup_folder = entry[3], entry[6]
+        if key in canonical:
+            # Another copy of a message already merged: it only adds a folder membership
+            first, record = canonical[key]
+            if dup_folder is None: dup_folder = meta_from_json(entry[1])['folder']
+            if dup_folder != record.folder and dup_folder not in record.dup_folders:
+                record.dup_folders += (sys.intern(dup_folder),)
+            # The manifest keeps a full copy, so this row stands on its own if the first copy goes away
+            if manifest and entry[1] is None:
+                entry[1:3] = meta_to_json(dict(meta_from_json(first[1]), folder=dup_folder)), first[2]
+            metrics.count('duplicate_messages')
+            continue
+        if dup_folder is not None:
+            metrics.count('skipped_messages')  # The copy it duplicates could not be extracted
+            continue
+        if entry[4] is not None:
+            meta, extracted_meta = extracted_meta, None
+            if meta is None:
+                metrics.count('skipped_messages')
+                continue
+            terms = meta.pop('terms')
+            metrics.count('attachments', meta['att_count'])
+            metrics.count('attachment_bytes_written', meta.pop('att_bytes_written'))
+            if manifest: entry[1:3] = meta_to_json(meta), " ".join(terms)
+        else:
+            meta = meta_from_json(entry[1])
+            terms = entry[2].split()
+        if meta.get('lazy') and entry[5] and lazy_table:
+            # Offsets are stored relative to the message, so a reused message that moved in its mbox stays valid
+            mbox_path, msg_start = entry[5]
+            lazy_table.add((path, os.path.abspath(mbox_path), msg_start + offset, length, encoding)
+                           for path, offset, length, encoding in meta['lazy'])
+        record = MessageRecord(meta, ids)
+        search_index.add(record.num, terms)
+        if manifest:
+            if 'blobs' in meta: live_blobs.update(meta['blobs'])
+            else: untracked += 1
+            live_fragments[record.frag[0]] = live_fragments.get(record.frag[0], 0) + record.frag[2]
+
+        engine.add_message(record.mid, record)
+        if key: canonical[key] = (entry, record)
+        metrics.count('messages')
+
+    if pool is None: close_worker_files()
+    if lazy_table: lazy_table.close()
+    del seen_keys, canonical  # Only needed while merging
+    if manifest:
+        for mbox_key, (st, rows) in mbox_entries.items():
+            manifest.replace_mbox(mbox_key, st, [e[:4] for e in rows if e[1] is not None])
+        manifest.set_state('msg_counter', msg_counter)
+
+    link_messages(engine, ids, metrics)
+
+    # --- PHASE 3: REMOVED (NO SUBJECT MERGING) ---
+    log.info("[PHASE 3] Subject Merging DISABLED (Preventing 'Stacking')...")
+
+    # --- PHASE 4: FLATTEN & SORT ---
+    metrics.begin('flatten')
+    log.info("[PHASE 4] Generating Thread Views...")
+
+    final_threads = []
+    fragments = FragmentStore(fragment_dir)
+    catalog = Catalog(os.path.join(output_path, CATALOG_NAME))
+    writer = WriteBehind()  # Pages and index files are written while the next ones are assembled
+    thread_id_counter = manifest.get_state('thread_counter') if manifest else 0
+    known_threads = manifest.threads() if manifest else {}  # member signature -> tid
+    current_threads = {}
+
+    for msgs in engine.threads():
+        msgs.sort(key=lambda x: x.epoch)
+
+        # Incremental runs keep a thread page as long as its membership (and, if split, its paging) is unchanged
+        pages = paginate(msgs, thread_page_size, thread_page_bytes)
+        paging = f"#{thread_page_size}:{thread_page_bytes}" if len(pages) > 1 else ""
+        signature = hashlib.sha1(("|".join(m.local_id for m in msgs) + paging).encode('utf-8')).hexdigest()
+        tid = known_threads.get(signature)
+        if not (tid and os.path.exists(os.path.join(data_dir, f"{tid}.html"))):
+            thread_id_counter += 1
+            tid = f"t{thread_id_counter}"
+
+            # Pages go to the writer as chunks: header, one fragment per message, footer
+            for k in range(len(pages)):
+                writer.submit(os.path.join(data_dir, page_name(tid, k)),
+                              thread_page(tid, msgs[-1].subj, pages, k, lambda m: fragments.read(m.frag)))
+        current_threads[signature] = tid
+        final_threads.append(thread_entry(tid, msgs, len(pages)))
+        catalog.add_thread(final_threads[-1], msgs, ids)
+
+    final_threads.sort(key=lambda x: x['epoch'], reverse=True)
+    fragments.close()
+    catalog.close()
+    ids.close()
+
+    if manifest:
+        live = set(current_threads.values())
+        remove_thread_pages(data_dir, {tid for tid in known_threads.values() if tid not in live})
+        manifest.replace_threads(current_threads)
+        manifest.set_state('thread_counter', thread_id_counter)
+        # Attachments and fragments of removed or changed messages
+        if untracked:
+            log.info(f"Not removing unused attachments: {untracked} messages were converted before they were "
+                     f"tracked. Convert once without --incremental to start tracking them.")
+        else:
+            metrics.count('removed_blobs', remove_dead_blobs(data_dir, live_blobs))
+        metrics.count('fragment_bytes_reclaimed', compact_fragments(fragment_dir, manifest, live_fragments))
+        manifest.close()
+    else:
+        shutil.rmtree(build_dir, ignore_errors=True)  # Fragments are only kept around for --incremental
+
+    # --- PHASE 5: INDEX HTML ---
+    metrics.begin('index')
+    index_dir = os.path.join(data_dir, "index")
+    search_dir = os.path.join(data_dir, "search")
+    for d in (index_dir, search_dir):
+        if os.path.exists(d): shutil.rmtree(d)
+        os.makedirs(d)
+    search_shards = write_index(output_path, original_folder_name, final_threads, folder_counts, search_index, writer)
+    writer.close()
+
+    metrics.end()
+
+    log.info(f"Search index: {len(search_index.postings)} terms in {search_shards} shards.")
+    skipped_mboxes = metrics.counters.get('skipped_mboxes', 0)
+    if skipped_mboxes: log.error(f"{skipped_mboxes} mbox files could not be read and are missing from the archive")
+    log.info(f"Done! Created STRICT archive at: {output_path}")
+    return dict({
+        'input': input_path,
+        'ok': not skipped_mboxes,
+        'output': output_path,
+        'messages': len(engine),
+        'threads': len(final_threads),
+        'input_bytes': metrics.counters.get('mbox_bytes', 0),
+        'output_bytes': sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(output_path) for f in files),
+    }, **metrics.report())
+
+
+# --- SERVE MODE ---
+
+_SERVED_PAGE_RE = re.compile(r'data/(t\d+)(?:_p(\d+))?\.html')
+_SERVED_BLOB_RE = re.compile(r'data/blobs/[0-9a-f]{2}/[0-9a-f]{62}(?:\.[a-z0-9]{1,8})?')
+
+
+class LRUCache:
+    """Byte strings kept up to max_bytes in total; the least recently used ones are dropped first."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None: self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes: return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None: self.size -= len(old)
+            self._items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, dropped = self._items.popitem(last=False)
+                self.size -= len(dropped)
+
+
+class MemoryWriter:
+    """Takes the files a WriteBehind would write and keeps them in memory, keyed by their /-separated path."""
+
+    def __init__(self):
+        self.files = {}
+
+    def submit(self, path, chunks):
+        self.files[path.replace(os.sep, "/")] = "".join(chunks).encode("utf-8")
+
+
+_HIGH_BYTES = bytes(range(128, 256))
+
+
+def estimate_fragment(msg, meta):
+    """
+    About the size of render_fragment() for a message that is not rendered yet: its header block exactly,
+    the body part extract_content() would pick (decoded, but not rendered) and a line per attachment.
+    """
+    html_part = plain_part = None
+    attachments = 0
+    for depth, part, part_start, part_end in iter_mime_parts(msg.buf, msg.start, msg.end, headers=msg.headers):
+        ctype = part.get_content_type()
+        if depth == 0:
+            if ctype == "text/html": html_part = (part, part_start, part_end)
+            else: plain_part = (part, part_start, part_end)
+            break
+        if part.get_filename() or "image" in ctype:
+            attachments += 1
+        elif ctype == "text/html":
+            html_part = (part, part_start, part_end)
+        elif ctype == "text/plain" and plain_part is None:
+            plain_part = (part, part_start, part_end)
+    size = len(render_fragment(msg, meta, "", []).encode("utf-8")) + 160 * attachments  # ~ one link or <img>
+    if html_part or plain_part:
+        part, part_start, part_end = html_part or plain_part
+        encoding = str(part.get('content-transfer-encoding', '')).strip().lower()
+        payload = decode_payload(msg.buf[part_start:part_end], encoding)
+        size += len(payload)
+        if (part.get_content_charset() or 'utf-8') not in ('utf-8', 'us-ascii'):
+            # Single-byte charsets (windows-1251, koi8-r) take two UTF-8 bytes per non-ASCII character
+            size += len(payload) - len(payload.translate(None, _HIGH_BYTES))
+    return size
+
+
+def index_message(task):
+    """
+    Serve-mode counterpart of extract_message(): the headers are decoded, and the body part that would be
+    shown is decoded only to size it for paging (estimate_fragment); attachments are not touched. The record's
+    frag points at the message itself, (mbox path, start, length), so it can be rendered when it is viewed.
+    """
+    mbox_path, start, end, local_id, folder_name = task
+    try:
+        msg = RawMessage(_reader_for(mbox_path).buf, start, end)
+        meta = message_meta(msg, local_id, folder_name)
+        if not meta['mid']: meta['mid'] = synthetic_mid(meta)
+        meta['frag'] = (mbox_path, start, end - start)
+        meta['size'] = estimate_fragment(msg, meta)  # What paginate() goes by, as frag is the raw message
+        meta['terms'] = search_terms(meta['subj'], meta['sender'])  # Bodies are not read up front
+        return meta
+    except Exception as e:
+        log.warning(f"Skipping corrupt message {local_id}: {e}")
+        return None
+
+
+class ServedArchive:
+    """
+    An export prepared for --serve: message metadata, the thread graph and the index files are built at
+    startup; thread pages are rendered from the mbox files when first requested, and attachments are
+    decoded when fetched. Both go into an LRUCache of cache_bytes. Search covers subjects and senders.
+    Threads are paged by estimate_fragment() sizes, so a byte-limited page may break one message off a conversion.
+    """
+
+    def __init__(self, input_path, jobs=1, pool=None, cache_bytes=SERVE_CACHE_MB * 1024 * 1024,
+                 thread_page_size=THREAD_PAGE_SIZE, thread_page_bytes=THREAD_PAGE_BYTES):
+        metrics = Metrics()
+        self.cache = LRUCache(cache_bytes)
+        self.sources = OrderedDict()  # lazy attachment path -> (mbox, offset, length, encoding), up to SERVE_SOURCES
+        self._sources_lock = threading.Lock()
+        self.blob_dir = tempfile.mkdtemp(prefix="mbox_serve_")  # Images split out of HTML bodies (rewrite_html)
+        self._render_lock = threading.Lock()
+
+        metrics.begin('ingest')
+        log.info("[PHASE 1] Indexing message headers...")
+        tasks = []
+        entries = []  # Per message in file order: (duplicate key, task index or None, folder of a duplicate copy)
+        seen_keys = set()
+        folder_counts = {}
+        plan = [(folder_name, mbox_path, plan_chunks(mbox_path, SCAN_CHUNK_BYTES))
+                for folder_name, mbox_path in iter_mboxes(input_path)]
+        scanned = scan_mboxes([c for *_, chunks in plan for c in chunks], pool=pool)
+        for folder_name, mbox_path, chunks in plan:
+            folder_counts.setdefault(folder_name, 0)
+            metrics.count('mbox_bytes', os.path.getsize(mbox_path))
+            results = [scanned.pop(c) for c in chunks]
+            if None in results:
+                log.warning(f"Skipping unreadable mbox {mbox_path}")
+                metrics.count('skipped_mboxes')
+                continue
+            for start, end, key, _ in (m for result in results for m in result):
+                folder_counts[folder_name] += 1
+                if key in seen_keys:
+                    entries.append((key, None, folder_name))
+                    continue
+                if key: seen_keys.add(key)
+                tasks.append((mbox_path, start, end, f"m{len(tasks) + 1}", folder_name))
+                entries.append((key, len(tasks) - 1, None))
+        del plan, scanned
+
+        if pool is not None and len(tasks) > 1:
+            results = list(pool.map(index_message, tasks, chunksize=max(1, min(256, len(tasks) // (jobs * 8)))))
+        else:
+            results = [index_message(t) for t in tasks]
+
+        engine = ThreadingEngine()
+        ids = StringTable()
+        search_index = SearchIndex()
+        canonical = {}  # duplicate key -> record of the first copy
+        sizes = {}  # record num -> estimated fragment size, for paginate()
+        for key, task_idx, dup_folder in entries:
+            if task_idx is None:
+                record = canonical.get(key)
+                if record and dup_folder != record.folder and dup_folder not in record.dup_folders:
+                    record.dup_folders += (sys.intern(dup_folder),)
+                metrics.count('duplicate_messages')
+                continue
+            meta = results[task_idx]
+            if meta is None:
+                metrics.count('skipped_messages')
+                continue
+            record = MessageRecord(meta, ids)
+            sizes[record.num] = meta['size']
+            search_index.add(record.num, meta['terms'])
+            engine.add_message(record.mid, record)
+            if key: canonical[key] = record
+            metrics.count('messages')
+        del tasks, entries, results, canonical
+
+        link_messages(engine, ids, metrics)
+        ids.close()
+
+        metrics.begin('flatten')
+        self.threads = {}  # tid -> (subject, pages of records)
+        final_threads = []
+        for n, msgs in enumerate(engine.threads(), 1):
+            msgs.sort(key=lambda x: x.epoch)
+            pages = paginate(msgs, thread_page_size, thread_page_bytes, sizes)
+            self.threads[f"t{n}"] = (msgs[-1].subj, pages)
+            final_threads.append(thread_entry(f"t{n}", msgs, len(pages)))
+        final_threads.sort(key=lambda x: x['epoch'], reverse=True)
+        del sizes
+
+        metrics.begin('index')
+        writer = MemoryWriter()
+        title = os.path.basename(input_path.rstrip(os.sep))
+        write_index("", title, final_threads, folder_counts, search_index, writer)
+        self.files = writer.files
+        self.report = dict({'input': input_path, 'messages': len(engine), 'threads': len(final_threads),
+                            'input_bytes': metrics.counters.get('mbox_bytes', 0)}, **metrics.report())
+
+    def close(self):
+        shutil.rmtree(self.blob_dir, ignore_errors=True)
+        close_worker_files()
+
+    def render_message(self, m):
+        """The fragment of one message, rendered from its mbox; its attachments are only located."""
+        mbox_path, start, length = m.frag
+        try:
+            msg = RawMessage(_reader_for(mbox_path).buf, start, start + length)
+            meta = message_meta(msg, m.local_id, m.folder)
+            body, atts = extract_content(msg.buf, start, start + length, self.blob_dir, lazy=True)
+        except Exception as e:
+            log.warning(f"Cannot render message {m.local_id}: {e}")
+            return ""
+        for a in atts:
+            if 'source' in a:
+                offset, size, encoding = a['source']
+                self.remember_source(a['path'], (mbox_path, start + offset, size, encoding))
+        return render_fragment(msg, meta, body, atts)
+
+    def remember_source(self, rel_path, source):
+        with self._sources_lock:
+            self.sources[rel_path] = source
+            self.sources.move_to_end(rel_path)
+            if len(self.sources) > SERVE_SOURCES: self.sources.popitem(last=False)
+
+    def source(self, rel_path):
+        """Where a lazy attachment of a rendered page lives, or None once it has been forgotten."""
+        with self._sources_lock:
+            source = self.sources.get(rel_path)
+            if source is not None: self.sources.move_to_end(rel_path)
+            return source
+
+    def get(self, path):
+        """The content of an archive path ('index.html', 'data/t1.html', ...), or None if there is none."""
+        data = self.files.get(path)
+        if data is None: data = self.cache.get(path)
+        if data is not None: return data
+
+        page = _SERVED_PAGE_RE.fullmatch(path)
+        source = self.source(path[5:]) if path.startswith("data/lazy/") else None
+        if page and page.group(1) in self.threads and page.group(2) != "1":
+            subject, pages = self.threads[page.group(1)]
+            k = int(page.group(2) or 1) - 1
+            if k >= len(pages): return None
+            with self._render_lock:  # Renders share the mmaps and may write the same blob
+                data = "".join(thread_page(page.group(1), subject, pages, k, self.render_message)).encode("utf-8")
+        elif source is not None:
+            data = load_lazy_source(path[5:], *source)
+        elif _SERVED_BLOB_RE.fullmatch(path):
+            try:
+                with open(os.path.join(self.blob_dir, path[5:]), "rb") as f: data = f.read()
+            except OSError:
+                return None
+        if data is not None: self.cache.put(path, data)
+        return data
+
+
+def serve(archive, host="127.0.0.1", port=SERVE_PORT):
+    """Serves a ServedArchive over HTTP until interrupted."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip("/") or "index.html"
+            data = archive.get(path)
+            if data is None: return self.send_error(404)
+            ctype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            if ctype.startswith("text/") or ctype.endswith("javascript"): ctype += "; charset=utf-8"
+            self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            log.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    log.info(f"Serving at http://{host}:{server.server_address[1]}/ (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert Apple Mail exports into browsable HTML archives.")
+    parser.add_argument("inputs", nargs="*", metavar="EXPORT",
+                        help="Apple Mail export folder(s); prompts for one when omitted")
+    parser.add_argument("-o", "--output", metavar="DIR",
+                        help="directory for the <export>_html archives (default: next to each export)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="worker processes shared by all exports (0 = one per CPU core)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="reuse the previous output and only process new or changed messages")
+    parser.add_argument("--low-memory", action="store_true",
+                        help="keep the Message-ID table on disk so memory stays flat on huge archives")
+    parser.add_argument("--lazy-attachments", action="store_true",
+                        help="only locate attachments in the mbox files; decode them later with --materialize")
+    parser.add_argument("--thread-page-size", type=int, default=THREAD_PAGE_SIZE, metavar="N",
+                        help=f"split conversations longer than N messages into pages (default {THREAD_PAGE_SIZE}, 0 = never)")
+    parser.add_argument("--thread-page-bytes", type=int, default=THREAD_PAGE_BYTES, metavar="N",
+                        help=f"split conversations larger than N bytes of HTML into pages (default {THREAD_PAGE_BYTES}, 0 = never)")
+    parser.add_argument("--materialize", action="store_true",
+                        help="treat the arguments as converted archives and decode their pending lazy attachments")
+    parser.add_argument("--serve", action="store_true",
+                        help="serve the export over HTTP, rendering conversations when they are opened instead of converting")
+    parser.add_argument("--host", default="127.0.0.1", help="address for --serve (default 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=SERVE_PORT, help=f"port for --serve (default {SERVE_PORT})")
+    parser.add_argument("--cache-mb", type=int, default=SERVE_CACHE_MB, metavar="MB",
+                        help=f"memory for pages and attachments cached by --serve (default {SERVE_CACHE_MB})")
+    parser.add_argument("--json", action="store_true",
+                        help="print a JSON summary of the run to stdout")
+    parser.add_argument("--report", metavar="FILE",
+                        help="write the JSON run report (phase timings, counters, rates) to FILE")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log every threading decision")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only log warnings and errors")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write cProfile stats of every conversion in the main process to FILE "
+                             "(view with python -m pstats); worker processes are not profiled")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="trace Python allocations in the main process and add the top sites to the report")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING if args.quiet else logging.INFO,
+                        format="%(message)s", stream=sys.stderr)
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+
+    inputs = args.inputs
+    if not inputs:
+        log.info("--- DEBUG GRAPH THREADING ENGINE (STRICT) ---")
+        raw_input = input("Drag and drop your 'Mail Export' folder here: ").strip()
+        inputs = [raw_input.strip("'").strip('"')]
+
+    if args.serve:
+        if len(inputs) != 1 or not os.path.isdir(inputs[0]):
+            log.error("--serve takes exactly one export folder")
+            return 1
+        pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+        try:
+            archive = ServedArchive(inputs[0], jobs, pool, args.cache_mb * 1024 * 1024,
+                                    args.thread_page_size, args.thread_page_bytes)
+        finally:
+            if pool is not None: pool.shutdown()
+        log.info(f"Indexed {archive.report['messages']} messages into {archive.report['threads']} conversations "
+                 f"in {archive.report['elapsed']}s.")
+        try:
+            serve(archive, args.host, args.port)
+        finally:
+            archive.close()
+        return 0
+
+    def output_for(input_path):
+        export_dir = os.path.abspath(input_path.rstrip(os.sep))
+        return os.path.join(args.output or os.path.dirname(export_dir), f"{os.path.basename(export_dir)}_html")
+
+    if not args.materialize:
+        # Compared without case, as on the default macOS file system
+        claimed = {}
+        for path in inputs:
+            claimed.setdefault(os.path.normcase(output_for(path)).lower(), []).append(path)
+        clashes = [paths for paths in claimed.values() if len(paths) > 1]
+        if clashes:
+            for paths in clashes:
+                log.error(f"{', '.join(paths)} would all be written to {output_for(paths[0])}; "
+                          f"convert them with different -o folders")
+            return 1
+
+    def run(input_path):
+        if args.materialize:
+            written, failed = materialize_attachments(input_path)
+            log.info(f"{input_path}: materialized {written} attachments, {failed} failed")
+            return {'input': input_path, 'ok': os.path.isdir(input_path) and not failed,
+                    'written': written, 'failed': failed}
+        if not os.path.isdir(input_path):
+            log.error(f"Folder not found: {input_path}")
+            return {'input': input_path, 'ok': False, 'error': "folder not found"}
+        output_path = output_for(input_path)
+        try:
+            return convert(input_path, output_path, jobs, pool, args.incremental, args.low_memory,
+                           args.lazy_attachments, args.thread_page_size, args.thread_page_bytes)
+        except Exception as e:
+            log.exception(f"Conversion of {input_path} failed: {e}")
+            return {'input': input_path, 'ok': False, 'error': str(e)}
+
+    profiles = []
+
+    def profiled(input_path):
+        # cProfile only sees the thread that enables it, so each conversion gets its own profiler
+        profiler = cProfile.Profile()
+        profiles.append(profiler)
+        profiler.enable()
+        try:
+            return run(input_path)
+        finally:
+            profiler.disable()
+
+    started = time.perf_counter()
+    if args.tracemalloc: tracemalloc.start()
+    task = profiled if args.profile else run
+    pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    try:
+        if pool is not None and len(inputs) > 1:
+            # Exports run side by side and feed the same worker pool
+            with ThreadPoolExecutor(max_workers=min(len(inputs), jobs)) as runner:
+                results = list(runner.map(task, inputs))
+        else:
+            results = [task(path) for path in inputs]
+    finally:
+        if pool is not None: pool.shutdown()
+        if profiles: pstats.Stats(*profiles).dump_stats(args.profile)
+
+    ok = all(r['ok'] for r in results)
+    summary = {'ok': ok, 'jobs': jobs, 'exports': results, 'elapsed': round(time.perf_counter() - started, 3)}
+    if args.tracemalloc:
+        summary['tracemalloc'] = {
+            'peak_bytes': tracemalloc.get_traced_memory()[1],
+            'top': [{'site': str(stat.traceback), 'bytes': stat.size}
+                    for stat in tracemalloc.take_snapshot().statistics('lineno')[:10]]
+        }
+        tracemalloc.stop()
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    return 0 if ok else 1
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,153 @@
+import os
+import sys
+import glob
+import email
+import quopri
+import random
+import base64
+import binascii
+import argparse
+import datetime
+from email.utils import parsedate_to_datetime
+
+import main as converter
+
+# --- CONFIGURATION ---
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CORPUS_DIR = os.path.join(REPO_DIR, "bench_corpus")
+SHOW_MISMATCHES = 3  # Printed per check; the rest are only counted
+
+
+# --- CHECKS ---
+# Each one compares a fast path of main.py with the stdlib code it replaces and returns (cases, mismatches).
+
+def mbox_files(paths):
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+        else:
+            yield from sorted(glob.glob(os.path.join(path, "**", "mbox"), recursive=True))
+
+
+def check_mime(paths):
+    """iter_mime_parts() against email.parser: the same leaf parts, content types and decoded bodies."""
+    cases, mismatches = 0, []
+    for mbox in mbox_files(paths):
+        with converter.MboxReader(mbox) as reader:
+            for msg in reader:
+                cases += 1
+                ours = [(headers.get_content_type(), converter.decode_payload(
+                            msg.buf[start:end], str(headers.get('content-transfer-encoding', '')).strip().lower()))
+                        for _, headers, start, end in converter.iter_mime_parts(msg.buf, msg.start, msg.end)]
+                parsed = email.message_from_bytes(msg.buf[msg.start:msg.end])
+                theirs = [(part.get_content_type(), part.get_payload(decode=True))
+                          for part in parsed.walk() if not part.is_multipart()]
+                if ours != theirs: mismatches.append(f"{mbox} @ {msg.start}")
+    return cases, mismatches
+
+
+def random_encoded(rng):
+    """A random payload in a random transfer encoding, often damaged the way real mail is."""
+    payload = rng.randbytes(rng.randrange(600))
+    kind = rng.random()
+    if kind < 0.5:
+        data = base64.encodebytes(payload)
+        if rng.random() < 0.5: data = data.replace(b"\n", rng.choice([b"\r\n", b" ", b"", b"\n\n"]))
+        if rng.random() < 0.3: data = data.rstrip(b"=\n")  # Missing padding
+        if rng.random() < 0.3: data += base64.encodebytes(rng.randbytes(rng.randrange(50)))  # Concatenated
+        if rng.random() < 0.2:
+            k = rng.randrange(len(data) + 1)
+            data = data[:k] + rng.choice([b"=", b"==", b"!", b"*", b"-"]) + data[k:]
+        if rng.random() < 0.1: data = data[:rng.randrange(len(data) + 1)]  # Truncated
+        return data, 'base64'
+    if kind < 0.9:
+        data = quopri.encodestring(payload)
+        if rng.random() < 0.3: data = data.replace(b"\n", b"\r\n")
+        if rng.random() < 0.3: data = data.replace(b"=\n", b"").replace(b"=\r\n", b"")  # Overlong lines
+        if rng.random() < 0.2:
+            k = rng.randrange(len(data) + 1)
+            data = data[:k] + rng.choice([b"=", b"==", b"=\r", b"=Z", b"=4"]) + data[k:]
+        return data, 'quoted-printable'
+    return payload, rng.choice(['7bit', '', 'binary'])
+
+
+def check_decoder(rng, count):
+    """iter_decoded() at assorted chunk sizes against decode_payload(), i.e. Message.get_payload(decode=True)."""
+    mismatches = []
+    chunk_bytes = converter.STREAM_CHUNK_BYTES
+    try:
+        for _ in range(count):
+            data, encoding = random_encoded(rng)
+            converter.STREAM_CHUNK_BYTES = rng.choice([1, 2, 3, 5, 7, 16, 64, 1000])
+            try:
+                streamed = b"".join(converter.iter_decoded(data, 0, len(data), encoding))
+            except binascii.Error:
+                streamed = b""
+            if streamed != converter.decode_payload(data, encoding):
+                mismatches.append(f"{encoding} at {converter.STREAM_CHUNK_BYTES} bytes: {data!r}")
+    finally:
+        converter.STREAM_CHUNK_BYTES = chunk_bytes
+    return count, mismatches
+
+
+def stdlib_date(date_str):
+    """What parse_date() stood for before its fast path: parsedate_to_datetime, read as UTC when naive."""
+    try:
+        dt = parsedate_to_datetime(date_str)
+    except Exception:
+        return converter._NO_DATE
+    if dt.tzinfo is None: dt = dt.replace(tzinfo=datetime.timezone.utc)
+    offset = dt.utcoffset()
+    return int(dt.timestamp()), int(offset.total_seconds()) // 60 if offset else 0
+
+
+def random_date(rng):
+    day_name = rng.choice(['Mon', 'tue', 'SUN', 'Xyz', ''])
+    separator = rng.choice([', ', ',', ' ', '  ', '']) if day_name else ''
+    time_of_day = f"{rng.randint(0, 25)}:{rng.randint(0, 61):02d}" + rng.choice(['', f":{rng.randint(0, 61):02d}"])
+    text = (f"{day_name}{separator}{rng.choice([0, 1, 9, 28, 29, 30, 31, 32, '01'])} "
+            f"{rng.choice(['Jan', 'feb', 'DEC', 'Sep', 'Foo'])} {rng.choice([1, 99, 1000, 1970, 2024, 9999, '0000'])} "
+            f"{time_of_day} {rng.choice(['+0000', '-0000', '+0530', '-0800', 'GMT', 'UT', 'z', 'EST', '+2400', '-2359', '+0099', '(PDT)', '+0200 (CEST)', '+0200 junk', ''])}")
+    return f" {text} " if rng.random() < 0.1 else text
+
+
+def check_dates(paths, rng, count):
+    """parse_date() against parsedate_to_datetime, and format_epoch() against strftime."""
+    samples = {random_date(rng) for _ in range(count)}
+    for mbox in mbox_files(paths):
+        with converter.MboxReader(mbox) as reader:
+            samples.update(converter.decode_header_safe(msg.get('date', '')) for msg in reader)
+    mismatches = [repr(s) for s in samples if converter.parse_date.__wrapped__(s) != stdlib_date(s)]
+    epoch_start = datetime.datetime(1970, 1, 1)
+    for _ in range(count):
+        epoch, tzoff = rng.randint(-62135596800 + 86400, 253402214400 - 86400), rng.randint(-1439, 1439)
+        expected = (epoch_start + datetime.timedelta(seconds=epoch + tzoff * 60)).strftime('%Y-%m-%d %H:%M')
+        if converter.format_epoch(epoch, tzoff) != expected: mismatches.append(f"format_epoch({epoch}, {tzoff})")
+    return len(samples) + count, mismatches
+
+
+# --- MAIN ---
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check main.py's MIME walker, streaming decoder and date parser "
+                                                 "against the Python standard library.")
+    parser.add_argument("paths", nargs="*", help=f"exports or mbox files to read (default: {DEFAULT_CORPUS_DIR})")
+    parser.add_argument("--cases", type=int, default=50000, help="random cases per generated check (default 50000)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    paths = args.paths or ([DEFAULT_CORPUS_DIR] if os.path.isdir(DEFAULT_CORPUS_DIR) else [])
+    if not paths: print("No exports given and no bench_corpus/ yet: MIME parts are not checked", file=sys.stderr)
+
+    rng = random.Random(args.seed)
+    failed = False
+    for name, (cases, mismatches) in (("mime parts", check_mime(paths)),
+                                      ("streaming decoder", check_decoder(rng, args.cases)),
+                                      ("dates", check_dates(paths, rng, args.cases))):
+        print(f"{name}: {cases} cases, {len(mismatches)} mismatches")
+        for mismatch in mismatches[:SHOW_MISMATCHES]: print(f"  {mismatch[:300]}")
+        failed |= bool(mismatches)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())